@@ -4,356 +4,2955 @@
 #
 
 import psycopg2
+import psycopg2.pool
 from psycopg2.extensions import AsIs
 from psycopg2.sql import SQL, Identifier, Literal
+import inspect
+import json
 import logging
+import multiprocessing
 import os
+import io
+import math
+import struct
+import heapq
+import queue
+import bz2
+import gzip
+import lzma
+from collections import namedtuple
+from itertools import islice
+import tempfile
+import threading
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import wraps
 from io import StringIO
-import time  # Import time module for logging execution time
+from bisect import bisect_left
+import time
 
-logging.basicConfig(level=logging.INFO)
+try:
+    import numpy as np  # Chỉ cần cho parser='mmap'
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
 
 DATABASE_NAME = 'dds_assgn1'
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + bytes(8)  # Chữ ký, flags = 0, độ dài phần mở rộng = 0
+BINARY_COPY_TRAILER = b'\xff\xff'
+BINARY_COPY_ROW = struct.Struct('>hiiiiid')  # 3 cột: (độ dài, giá trị) của userid, movieid, rating
+PARTITION_CATALOG = 'partition_catalog'  # Không được bắt đầu bằng tiền tố của các bảng partition
+LOAD_CHECKPOINTS = 'load_checkpoint'  # Vị trí đã tải (byte) của mỗi lần loadratings với resume=True
+RROBIN_INDEX_SEQUENCE = 'rrobin_index_seq'  # Vị trí round robin tiếp theo, dùng chung cho mọi kết nối
+PARTITION_CACHE = {}  # (dsn, prefix) -> PartitionLayout, xóa khi tiến trình này tạo lại partition
+POOL_SIZE = 8  # Số kết nối tối đa mặc định của mỗi pool
+POOL_CHECKOUT_TIMEOUT = 60.0  # Số giây tối đa chờ kết nối cho worker của parallel_execute
+POOL_HEALTH_CHECK_INTERVAL = 30.0  # Kết nối rảnh quá số giây này được thử SELECT 1 trước khi dùng
+POOLS = {}  # Tham số kết nối -> ConnectionPool dùng chung trong tiến trình
+PREPARED_STATEMENTS = weakref.WeakKeyDictionary()  # Kết nối -> {câu SQL: tên prepared statement trên server}
+PREPARED_STATEMENT_LIMIT = 256  # Quá số này thì DEALLOCATE ALL và chuẩn bị lại từ đầu
+CREATED_DATABASES = set()  # Database đã kiểm tra/tạo bởi create_db trong tiến trình này
+QUERY_FETCH_SIZE = 10_000  # Số dòng mỗi lần lấy từ server-side cursor của các hàm truy vấn
+INDEX_COLUMNS = ('userid', 'movieid')  # Cột được tạo chỉ mục B-tree bởi buildindexes
+WRITE_BUFFER_ROWS = 10_000  # BufferedWriter flush khi hàng đợi đạt số dòng này
+WRITE_BUFFER_DELAY = 1.0  # ... hoặc khi dòng cũ nhất đã đợi quá số giây này
+LATENCY_BUCKETS = [1e-5 * 2 ** k for k in range(25)]  # Cận trên (giây) các ô độ trễ: 10µs .. ~168s
+RESUME_CHUNK_ROWS = 500_000  # Số dòng mỗi lần commit khi tải với resume=True
+PIPELINE_BATCH_ROWS = 100_000  # Số dòng mỗi batch COPY của copy_ratings_pipeline
+PIPELINE_DEPTH = 4  # Số batch tối đa chờ trong hàng đợi giữa luồng đọc và luồng COPY
+# Tổng dữ liệu giữ trong RAM, chia đều cho các partition, trước khi ghi ra file tạm
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+BULK_MODES = (None, 'freeze', 'unlogged')  # Chế độ ghi hàng loạt của loadratings và các hàm phân vùng
+PARTITION_PREFIXES = {'range': 'range_part', 'roundrobin': 'rrobin_part', 'hash': 'hash_part'}  # Scheme -> tiền tố
+# Bảng độc lập cho mỗi partition, hoặc partition khai báo của PostgreSQL
+PARTITION_BACKENDS = ('tables', 'declarative')
+# Ai chọn partition cho dòng mới: hàm insert phía Python, hoặc trigger trong database
+ROUTING_MODES = ('client', 'trigger')
+
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}  # Đuôi file nén -> hàm mở
+
+# backend 'declarative': các partition gắn vào bảng cha partition_parent(ratingstablename, prefix)
+# routing 'trigger': một trigger trên bảng chính ghi các dòng mới vào partition (install_routing_trigger)
+PartitionLayout = namedtuple('PartitionLayout', ['scheme', 'ratingstablename', 'partition_count', 'boundaries',
+                                                 'backend', 'partition_key', 'routing'],
+                             defaults=['tables', None, 'client'])
+
+class PhaseStats:
+    """
+    Timings of one instrumented function or phase: call count, total and extreme seconds, rows handled
+    and a latency histogram over LATENCY_BUCKETS (the last slot counts slower calls).
+    """
+    __slots__ = ('count', 'seconds', 'min', 'max', 'rows', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.rows = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds, rows):
+        self.count += 1
+        self.seconds += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.rows += rows
+        self.histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the histogram slot holding the @fraction quantile (the exact maximum for the last slot).
+        """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return min(LATENCY_BUCKETS[index], self.max) if index < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'mean': self.seconds / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'rows': self.rows,
+            'rows_per_sec': self.rows / self.seconds if self.seconds else 0.0,
+            'histogram': [[LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else None, count]
+                          for index, count in enumerate(self.histogram) if count],
+        }
+
+
+class Metrics:
+    """
+    In-process registry of PhaseStats by name, filled by the @timed functions and phase() blocks.
+    Public functions record under their own name; their phases are 'parse' (input rows to COPY data),
+    'copy' (COPY into a table), 'route' (single-pass scan), '<function>.fill' and '<function>.commit'.
+    Disabled by default: instrumented code then only tests the @enabled flag.
+    Each recorded timing is also logged at DEBUG level.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def record(self, name, seconds, rows=0):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = PhaseStats()
+            stats.add(seconds, rows)
+        logger.debug("%s completed in %.4f seconds (%d rows)", name, seconds, rows)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def snapshot(self):
+        """
+        Name -> summary dict (count, seconds, mean/min/max, p50/p90/p99, rows, rows_per_sec, histogram
+        as [upper bound in seconds, count] pairs, None for the overflow slot).
+        """
+        with self.lock:
+            return {name: stats.summary() for name, stats in sorted(self.stats.items())}
+
+    def to_json(self, path=None):
+        """
+        The snapshot as a JSON string, also written to @path if given.
+        """
+        text = json.dumps(self.snapshot(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+
+METRICS = Metrics()
+
+
+class Phase:
+    """
+    Timed block of phase(): records its duration and the rows counted in .rows when it exits.
+    """
+    __slots__ = ('name', 'rows', 'start')
+
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        METRICS.record(self.name, time.perf_counter() - self.start, self.rows)
+
+
+class NullPhase:
+    """
+    Stand-in returned by phase() while metrics are disabled; ignores everything.
+    """
+    __slots__ = ()
+    rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+def phase(name, rows=0):
+    """
+    Context manager timing a block as @name: `with phase('copy') as p: ...; p.rows += n`.
+    """
+    if not METRICS.enabled:
+        return NULL_PHASE
+    return Phase(name, rows)
+
+
+def timed_iter(name, items, rows=len):
+    """
+    Iterates @items, recording the time spent producing each item as @name with @rows(item) rows.
+    Returns @items unchanged while metrics are disabled.
+    """
+    if not METRICS.enabled:
+        return items
+    return timed_items(name, iter(items), rows)
+
+
+def timed_items(name, items, rows):
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        METRICS.record(name, time.perf_counter() - start, rows(item))
+        yield item
+
+
+def timed(name, rows=None):
+    """
+    Decorator recording every call of the function as @name in METRICS. @rows is the row count of a call,
+    or a function mapping the return value to it. Generator functions are timed until exhausted and count
+    the rows they yield.
+    """
+    def decorate(function):
+        if inspect.isgeneratorfunction(function):
+            @wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                if not METRICS.enabled:
+                    return (yield from function(*args, **kwargs))
+                start = time.perf_counter()
+                count = 0
+                try:
+                    for row in function(*args, **kwargs):
+                        count += 1
+                        yield row
+                finally:
+                    METRICS.record(name, time.perf_counter() - start, count)
+            return generator_wrapper
 
-# Helper function to log execution time
-def log_execution_time(func_name, start_time):
-    end_time = time.time()
-    execution_time = end_time - start_time
-    logging.info(f"Function {func_name} completed in {execution_time:.4f} seconds")
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            finally:
+                if callable(rows):
+                    count = rows(result) if result is not None else 0
+                else:
+                    count = rows or 0
+                METRICS.record(name, time.perf_counter() - start, count)
+        return wrapper
+    return decorate
 
+@timed("getopenconnection")
 def getopenconnection(user='postgres', password='1234', dbname='postgres'):
-    start_time = time.time()
     connection = psycopg2.connect("dbname='" + dbname + "' user='" + user + "' host='localhost' password='" + password + "'")
-    log_execution_time("getopenconnection", start_time)
     return connection
 
 
-def loadratings(ratingstablename, ratingsfilepath, openconnection): 
+class ConnectionPool:
+    """
+    Thread-safe pool of at most @size connections opened with getopenconnection(**@params).
+    Connections are checked out with `with pool.connection() as conn:`; a connection that sat idle longer
+    than @health_check_interval seconds is pinged before reuse and replaced if it is broken.
+    """
+    def __init__(self, size=POOL_SIZE, health_check_interval=POOL_HEALTH_CHECK_INTERVAL, **params):
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.params = params
+        self.idle = []  # (kết nối, thời điểm trả về pool), kết nối mới trả nằm cuối
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(size)
+        self.in_use = 0  # Số kết nối đang được mượn
+
+
+    def grow(self, size):
+        """
+        Raises the pool limit to @size connections (never shrinks it).
+        """
+        with self.lock:
+            extra = size - self.size
+            if extra > 0:
+                self.size = size
+                for _ in range(extra):
+                    self.slots.release()
+
+    def reserve(self, count):
+        """
+        Raises the pool limit so that @count more connections can be checked out on top of those in use,
+        e.g. the connection the caller of a parallel function borrowed from this pool.
+        """
+        with self.lock:
+            size = self.in_use + count
+        self.grow(size)
+
+    def healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        Takes a healthy connection from the pool, opening a new one if none is idle.
+        Blocks while all @size connections are in use.
+        """
+        if not self.slots.acquire(timeout=timeout):
+            raise psycopg2.pool.PoolError("connection pool exhausted")
+        with self.lock:
+            self.in_use += 1
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    conn, idle_since = self.idle.pop()
+                if self.healthy(conn, idle_since):
+                    return conn
+                conn.close()
+            return getopenconnection(**self.params)
+        except Exception:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+            raise
+
+    def release(self, conn):
+        """
+        Returns @conn to the pool, rolling back any open transaction; broken connections are discarded.
+        """
+        try:
+            if not conn.closed:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+                with self.lock:
+                    self.idle.append((conn, time.monotonic()))
+        except psycopg2.Error:
+            conn.close()
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def closeall(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+def get_pool(size=POOL_SIZE, **params):
+    """
+    Shared ConnectionPool for the getopenconnection @params (user, password, dbname),
+    holding at least @size connections.
+    """
+    key = tuple(sorted(params.items()))
+    pool = POOLS.get(key)
+    if pool is None:
+        pool = POOLS.setdefault(key, ConnectionPool(size, **params))
+    pool.grow(size)
+    return pool
+
+
+def close_pools():
+    """
+    Closes the idle connections of every shared pool.
+    """
+    for pool in POOLS.values():
+        pool.closeall()
+
+
+def accepts_pool(function):
+    """
+    Lets an entry point receive a ConnectionPool wherever it expects an open connection:
+    a connection is checked out of the pool for the duration of the call.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        pool = next((arg for arg in args + tuple(kwargs.values()) if isinstance(arg, ConnectionPool)), None)
+        if pool is None:
+            return function(*args, **kwargs)
+        with pool.connection() as conn:
+            args = tuple(conn if arg is pool else arg for arg in args)
+            kwargs = {name: conn if arg is pool else arg for name, arg in kwargs.items()}
+            return function(*args, **kwargs)
+    return wrapper
+
+
+@accepts_pool
+@timed("loadratings")
+def loadratings(ratingstablename, ratingsfilepath, openconnection, workers=1, parser='lines', copy_format='text',
+                bulk=None, indexes=None, pipeline=None, resume=False, chunk_rows=RESUME_CHUNK_ROWS):
     """
     Function to load data in @ratingsfilepath file to a table called @ratingstablename.
+    With @workers > 1 the file is split at line boundaries and the pieces are parsed and copied
+    by that many processes, each on its own connection.
+    @parser 'lines' reformats the file line by line into COPY rows, in the text format or, with
+    @copy_format 'binary', in PostgreSQL's binary format. 'mmap' memory-maps the file, parses whole
+    blocks into NumPy column arrays and always sends them with binary COPY (requires numpy).
+    @bulk selects a fast bulk mode (see bulk_transaction): 'freeze' creates and fills the table in one
+    transaction with COPY FREEZE (single process only), 'unlogged' loads into an UNLOGGED table that is
+    switched to LOGGED at the end. Both run ANALYZE once the data is in.
+    @indexes runs the index stage after the load (see index_stage): True for the default buildindexes
+    options, or a dict of buildindexes keyword arguments.
+    Files ending in .gz, .bz2 or .xz are decompressed as a stream (parser 'lines', single process only).
+    @pipeline reads and parses the file in a producer thread while the COPYs run (see copy_ratings_pipeline);
+    by default it is used for compressed files when not resuming.
+    @resume loads the file in committed chunks of @chunk_rows rows and picks up an interrupted load of
+    the same file where it stopped (see load_ratings_resumable); single process, no @bulk mode.
     """
-    start_time = time.time()
+    compressed = os.path.splitext(ratingsfilepath)[1].lower() in COMPRESSED_OPENERS
+    if pipeline is None:
+        pipeline = compressed and not resume
+    if parser not in ('lines', 'mmap'):
+        raise ValueError("parser must be 'lines' or 'mmap'")
+    if parser == 'mmap' and np is None:
+        raise ImportError("parser='mmap' requires numpy")
+    if (compressed or pipeline) and (parser == 'mmap' or workers > 1):
+        raise ValueError("compressed files and pipeline require parser='lines' and workers=1")
+    if resume and (parser == 'mmap' or workers > 1 or pipeline or bulk is not None):
+        raise ValueError("resume requires parser='lines', workers=1, no pipeline and no bulk mode")
+    if copy_format not in ('text', 'binary'):
+        raise ValueError("copy_format must be 'text' or 'binary'")
+    check_bulk_mode(bulk)
+    if bulk == 'freeze' and workers > 1:
+        raise ValueError("bulk='freeze' requires workers=1")
     create_db(DATABASE_NAME)
     conn = openconnection
-    cur = conn.cursor()
+    freeze = bulk == 'freeze'
     
+    with bulk_transaction(conn, bulk):
+        cur = conn.cursor()
+        try:
+            if not resume:
+                # Tạo bảng đích trực tiếp với cấu trúc cuối cùng
+                cur.execute(f"""
+                    DROP TABLE IF EXISTS {ratingstablename};
+                    {create_ratings_table_sql(ratingstablename, bulk)};
+                """)
+                # Trigger định tuyến bị xóa cùng bảng cũ
+                forget_routing(cur, ratingstablename)
+                # Checkpoint của lần tải resume trước (nếu có) không còn ứng với nội dung bảng
+                cur.execute("SELECT to_regclass(%s) IS NOT NULL", (LOAD_CHECKPOINTS,))
+                if cur.fetchone()[0]:
+                    cur.execute(f"DELETE FROM {LOAD_CHECKPOINTS} WHERE ratingstablename = %s", (ratingstablename,))
+                
+            if resume:
+                # Bảng chỉ được tạo lại khi bắt đầu một lần tải mới
+                load_ratings_resumable(ratingstablename, ratingsfilepath, conn, copy_format, chunk_rows)
+            elif workers > 1:
+                # Các worker dùng kết nối riêng nên bảng phải được commit trước
+                conn.commit()
+                load_ratings_parallel(ratingstablename, ratingsfilepath, conn, workers, parser, copy_format)
+            elif parser == 'mmap':
+                copy_ratings_arrays(cur, ratingstablename, parse_ratings_mmap(ratingsfilepath), freeze)
+            else:
+                # Xử lý từng dòng và định dạng lại để COPY
+                with open_ratings_file(ratingsfilepath) as f:
+                    if pipeline:
+                        copy_ratings_pipeline(cur, ratingstablename, f, copy_format=copy_format, freeze=freeze)
+                    else:
+                        copy_ratings_lines(cur, ratingstablename, f, copy_format=copy_format, freeze=freeze)
+                
+            finish_bulk_tables(cur, [ratingstablename], bulk, analyze=not indexes)
+            with phase("loadratings.commit"):
+                conn.commit()
+            
+            index_stage([ratingstablename], conn, indexes, workers)
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in loadratings: {e}")
+            raise
+        finally:
+            cur.close()
+
+
+@contextmanager
+def bulk_transaction(openconnection, bulk):
+    """
+    Context for a load or partition build in @bulk mode (one of BULK_MODES).
+    - 'freeze': the tables are created and filled in the same transaction, so COPY can use FREEZE (rows
+      written already frozen, no later hint-bit or freeze rewrites) and, with wal_level = minimal, PostgreSQL
+      skips WAL for the new tables. Autocommit is switched off for the duration so that holds.
+    - 'unlogged': the tables are created UNLOGGED (no WAL while filling) and set LOGGED at the end.
+    In both modes ANALYZE runs once at the end, after all rows are written (see finish_bulk_tables).
+    """
+    with explicit_transactions(openconnection, bulk == 'freeze'):
+        yield
+
+
+@contextmanager
+def explicit_transactions(openconnection, enabled=True):
+    """
+    Switches autocommit off for the duration (if @enabled and no transaction is open), so that statements
+    only take effect at the next commit(); the previous mode is restored afterwards.
+    """
+    autocommit = openconnection.autocommit
+    idle = openconnection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    if enabled and autocommit and idle:
+        openconnection.autocommit = False
     try:
-        # Tạo bảng đích trực tiếp với cấu trúc cuối cùng
-        cur.execute(f"""
-            DROP TABLE IF EXISTS {ratingstablename};
-            CREATE TABLE {ratingstablename} (
-                userid INTEGER,
-                movieid INTEGER,
-                rating FLOAT
-            );
-        """)
-        
-        # Sử dụng COPY command để tải dữ liệu vào bảng - cách nhanh nhất
-        batch_size = 500_000  # Batch lớn hơn để giảm số lần gọi DB
-        buffer = StringIO()
-        count = 0
-        
-        # Xử lý từng dòng và định dạng lại để COPY
-        with open(ratingsfilepath, 'r') as f:
-            for line in f:
-                # Tách và định dạng lại dữ liệu
-                parts = line.strip().split('::')
-                if len(parts) >= 3:
-                    buffer.write(f"{parts[0]}\t{parts[1]}\t{parts[2]}\n")
-                    count += 1
-                    
-                    # Đẩy dữ liệu theo batch
-                    if count % batch_size == 0:
-                        buffer.seek(0)
-                        cur.copy_expert(
-                            f"COPY {ratingstablename} (userid, movieid, rating) FROM STDIN WITH DELIMITER E'\t'",
-                            buffer
-                        )
-                        buffer.truncate(0)
-                        buffer.seek(0)
-        
-        # Xử lý phần còn lại
-        if buffer.tell() > 0:
-            buffer.seek(0)
-            cur.copy_expert(
-                f"COPY {ratingstablename} (userid, movieid, rating) FROM STDIN WITH DELIMITER E'\t'",
-                buffer
-            )
-        
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(f"Error in loadratings: {e}")
-        raise
+        yield
     finally:
-        cur.close()
-        log_execution_time("loadratings", start_time)
+        if openconnection.autocommit != autocommit:
+            openconnection.autocommit = autocommit
 
 
-def rangepartition(ratingstablename, numberofpartitions, openconnection):
+def check_bulk_mode(bulk, method='loop', backend='tables'):
     """
-    Function to create partitions of main table based on range of ratings.
+    Rejects @bulk modes that cannot be honoured by a partition build with @method and @backend.
     """
-    start_time = time.time()
-    conn = openconnection
-    cur = conn.cursor()
-    RANGE_TABLE_PREFIX = 'range_part'
-    
-    # Kiểm tra đầu vào
-    if not isinstance(numberofpartitions, int) or numberofpartitions <= 0:
-        raise ValueError("numberofpartitions phải là số nguyên dương")
+    if bulk not in BULK_MODES:
+        raise ValueError("bulk must be None, 'freeze' or 'unlogged'")
+    if bulk == 'freeze' and method == 'parallel':
+        # Các worker dùng kết nối riêng, không thể ghi trong transaction đã tạo bảng
+        raise ValueError("bulk='freeze' cannot be used with method='parallel'")
+    if bulk == 'unlogged' and backend == 'declarative':
+        raise ValueError("bulk='unlogged' cannot be used with backend='declarative'")
+
+
+def create_ratings_table_sql(tablename, bulk=None):
+    """
+    CREATE TABLE statement for a ratings or partition table, UNLOGGED in the 'unlogged' @bulk mode.
+    """
+    unlogged = "UNLOGGED " if bulk == 'unlogged' else ""
+    return f"CREATE {unlogged}TABLE {tablename} (userid INTEGER, movieid INTEGER, rating FLOAT)"
+
+
+def finish_bulk_tables(cur, tables, bulk, analyze=True):
+    """
+    End of a @bulk load into @tables: unlogged tables are set LOGGED, then statistics are gathered
+    (unless @analyze is False because the index stage will). Nothing is done outside bulk mode.
+    """
+    if bulk is None:
+        return
+    for table in tables:
+        if bulk == 'unlogged':
+            cur.execute(f"ALTER TABLE {table} SET LOGGED")
+        if analyze:
+            cur.execute(f"ANALYZE {table}")
+
+
+def index_stage(tables, openconnection, indexes, workers, brin=False):
+    """
+    Index stage run by the load and partition functions once their rows are committed, never while they are
+    still being written: nothing if @indexes is falsy, buildindexes(@tables) with @workers connections (and a
+    BRIN index on rating if @brin) if it is True, or buildindexes with the keyword arguments in @indexes.
+    """
+    if not indexes:
+        return
+    options = {'brin': brin, 'workers': max(1, workers)}
+    if isinstance(indexes, dict):
+        options.update(indexes)
+    buildindexes(tables, openconnection, **options)
+
+
+@timed("buildindexes")
+def buildindexes(tables, openconnection, columns=INDEX_COLUMNS, brin=False, analyze=True, workers=4):
+    """
+    Builds a B-tree index on each of @columns of every table in @tables, a BRIN index on rating if @brin,
+    and runs ANALYZE if @analyze. Indexes that already exist are kept. Each table is handled on its own
+    pooled connection, @workers tables at a time; the tables must be committed.
+    """
+    if not tables:
+        return
+    workers = max(1, min(workers, len(tables)))
+    pool = worker_pool(openconnection, workers)
     
-    # Tính toán khoảng phân vùng
-    interval = 5.0 / numberofpartitions
+    def build(table):
+        with pool.connection() as wconn, wconn.cursor() as wcur:
+            existing = single_column_indexes(wcur, table)
+            wanted = [('btree', column) for column in columns] + ([('brin', 'rating')] if brin else [])
+            for method, column in wanted:
+                if (method, column) not in existing:
+                    wcur.execute(f"CREATE INDEX ON {table} USING {method} ({column})")
+            if analyze:
+                wcur.execute(f"ANALYZE {table}")
+            wconn.commit()
     
-    try:
-        # Xóa và tạo lại các bảng partition
-        for i in range(numberofpartitions):
-            table_name = f"{RANGE_TABLE_PREFIX}{i}"
-            cur.execute(f"DROP TABLE IF EXISTS {table_name}")
-            cur.execute(f"CREATE TABLE {table_name} (userid INTEGER, movieid INTEGER, rating FLOAT)")
-        
-        conn.commit()
-        
-        # Phân vùng đầu tiên (0) - bao gồm giá trị 0
-        table_name = f"{RANGE_TABLE_PREFIX}0"
-        cur.execute(f"""
-            INSERT INTO {table_name} (userid, movieid, rating)
-            SELECT userid, movieid, rating FROM {ratingstablename}
-            WHERE rating >= 0 AND rating <= {interval}
-        """)
-        
-        # Các phân vùng 1 đến n-2
-        for i in range(1, numberofpartitions-1):
-            table_name = f"{RANGE_TABLE_PREFIX}{i}"
-            min_range = i * interval
-            max_range = (i + 1) * interval
-            
-            cur.execute(f"""
-                INSERT INTO {table_name} (userid, movieid, rating)
-                SELECT userid, movieid, rating FROM {ratingstablename}
-                WHERE rating > {min_range} AND rating <= {max_range}
-            """)
-        
-        # Phân vùng cuối cùng (n-1) - bao gồm giá trị 5.0
-        if numberofpartitions > 1:
-            table_name = f"{RANGE_TABLE_PREFIX}{numberofpartitions-1}"
-            min_range = (numberofpartitions - 1) * interval
-            
-            cur.execute(f"""
-                INSERT INTO {table_name} (userid, movieid, rating)
-                SELECT userid, movieid, rating FROM {ratingstablename}
-                WHERE rating > {min_range} AND rating <= 5.0
-            """)
-        
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(f"Error in rangepartition: {e}")
-        raise
-    finally:
-        cur.close()
-        log_execution_time("rangepartition", start_time)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(build, tables))
 
 
-def roundrobinpartition(ratingstablename, numberofpartitions, openconnection):
+def single_column_indexes(cur, table):
     """
-    Function to create partitions of main table using round robin approach.
+    Set of (access method, column name) of the single-column indexes of @table.
     """
-    start_time = time.time()
-    conn = openconnection
-    cur = conn.cursor()
-    RROBIN_TABLE_PREFIX = 'rrobin_part'
-    try:
-        # Tạo tất cả bảng partition trong một câu lệnh
-        create_tables_sql = []
-        for i in range(numberofpartitions):
-            create_tables_sql.append(f"""
-                DROP TABLE IF EXISTS {RROBIN_TABLE_PREFIX}{i};
-                CREATE TABLE {RROBIN_TABLE_PREFIX}{i} (userid INTEGER, movieid INTEGER, rating FLOAT);
-            """)
-        
-        cur.execute(";".join(create_tables_sql))
-        conn.commit()
-        
-        # Lấy tổng số dòng để tính partition
-        cur.execute(f"SELECT COUNT(*) FROM {ratingstablename}")
-        total_rows = cur.fetchone()[0]
-        
-        # Nếu không có dòng, không cần phân vùng
-        if total_rows == 0:
-            save_rr_index(0)
+    cur.execute("""
+        SELECT am.amname, a.attname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = c.relam
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = %s::regclass AND i.indnatts = 1
+    """, (table,))
+    return set(cur.fetchall())
+
+
+def index_options(cur, table):
+    """
+    buildindexes keyword arguments recreating the single-column indexes of @table on other tables,
+    or None if it has none.
+    """
+    existing = single_column_indexes(cur, table)
+    if not existing:
+        return None
+    return {'columns': tuple(sorted(column for method, column in existing if method == 'btree')),
+            'brin': ('brin', 'rating') in existing}
+
+
+def copy_ratings_lines(cur, ratingstablename, lines, batch_size=500_000, copy_format='text', freeze=False):
+    """
+    Parses `userid::movieid::rating::timestamp` @lines and COPYs them into @ratingstablename
+    in batches of @batch_size rows (with the FREEZE option if @freeze). Returns the number of copied rows.
+    """
+    count = 0
+    for data, rows in ratings_copy_batches(lines, batch_size, copy_format):
+        count += copy_ratings_data(cur, ratingstablename, data, rows, copy_format, freeze)
+    return count
+
+
+def ratings_copy_batches(lines, batch_size, copy_format='text'):
+    """
+    Yields (COPY data file, rows) for every @batch_size of the `userid::movieid::rating::timestamp` @lines:
+    tab-separated text, or a complete binary COPY stream with @copy_format 'binary'.
+    Lines with fewer than three fields are skipped.
+    """
+    lines = iter(lines)
+    while True:
+        with phase("parse") as parse:
+            chunk = list(islice(lines, batch_size))
+            if copy_format == 'binary':
+                batch = list(parse_ratings_lines(chunk))
+                data = io.BytesIO(encode_ratings_rows(batch))
+                rows = len(batch)
+            else:
+                # Tách và định dạng lại dữ liệu
+                buffer = StringIO()
+                rows = 0
+                for line in chunk:
+                    parts = line.strip().split('::')
+                    if len(parts) >= 3:
+                        buffer.write(f"{parts[0]}\t{parts[1]}\t{parts[2]}\n")
+                        rows += 1
+                buffer.seek(0)
+                data = buffer
+            parse.rows = rows
+        if not chunk:
             return
-        
-        # Sử dụng INSERT với MOD để phân vùng dữ liệu
-        for i in range(numberofpartitions):
-            cur.execute(f"""
-                INSERT INTO {RROBIN_TABLE_PREFIX}{i} (userid, movieid, rating)
-                SELECT userid, movieid, rating 
-                FROM (
-                    SELECT userid, movieid, rating, 
-                           ROW_NUMBER() OVER() AS rn 
-                    FROM {ratingstablename}
-                ) t
-                WHERE MOD(rn - 1, {numberofpartitions}) = {i}
-            """)
-        
-        # Khởi tạo file rr_index.txt
-        save_rr_index(total_rows % numberofpartitions)
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(f"Error in roundrobinpartition: {e}")
-        raise
-    finally:
-        cur.close()
-        log_execution_time("roundrobinpartition", start_time)
+        if rows:
+            yield data, rows
 
-def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
+
+def copy_ratings_data(cur, ratingstablename, data, rows, copy_format='text', freeze=False):
     """
-    Function to insert a new row into the main table and specific partition based on round robin approach.
+    COPYs one batch of @rows rows, read from the file @data in the COPY @copy_format, into @ratingstablename.
     """
-    start_time = time.time()
-    conn = openconnection
-    cur = conn.cursor()
-    RROBIN_TABLE_PREFIX = 'rrobin_part'
-    
-    try:
-        # Tính toán partition index - sử dụng rr_index.txt
-        if not os.path.exists("rr_index.txt"):
-            save_rr_index(0)
-        
-        current_index = get_rr_index()
-        numberofpartitions = count_partitions(RROBIN_TABLE_PREFIX, openconnection)
-        target_partition = current_index % numberofpartitions
-        
-        # Sử dụng một transaction duy nhất
-        cur.execute("""
-            INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s);
-        """.format(ratingstablename), (userid, itemid, rating))
-        
-        cur.execute("""
-            INSERT INTO {} (userid, movieid, rating) VALUES (%s, %s, %s);
-        """.format(f"{RROBIN_TABLE_PREFIX}{target_partition}"), (userid, itemid, rating))
-        
-        # Tăng index và lưu vào file
-        save_rr_index(current_index + 1)
-        
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(f"Error in roundrobininsert: {e}")
-        raise
-    finally:
-        cur.close()
-        log_execution_time("roundrobininsert", start_time)
+    with phase("copy", rows):
+        cur.copy_expert(copy_from_sql(ratingstablename, copy_format, freeze), data)
+    return rows
 
 
-def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
+def copy_ratings_pipeline(cur, ratingstablename, lines, batch_size=PIPELINE_BATCH_ROWS, copy_format='text',
+                          freeze=False, depth=PIPELINE_DEPTH):
     """
-    Function to insert a new row into the main table and specific partition based on range rating.
+    copy_ratings_lines with the reading (and decompressing) and parsing of @lines moved to a producer
+    thread, which hands the COPY batches over through a queue of at most @depth batches. The calling thread
+    only runs the COPYs, so client CPU work overlaps with the server, and at most @depth + 2 batches
+    are held in memory whatever the input size. Returns the number of copied rows.
     """
-    start_time = time.time()
-    conn = openconnection
-    cur = conn.cursor()
-    RANGE_TABLE_PREFIX = 'range_part'
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    
+    def put(item):
+        # Không chặn mãi khi bên COPY đã dừng vì lỗi
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for batch in ratings_copy_batches(lines, batch_size, copy_format):
+                if not put(batch):
+                    return
+            put(None)
+        except BaseException as e:
+            put(e)
     
+    producer = threading.Thread(target=produce, name="ratings-producer", daemon=True)
+    producer.start()
+    count = 0
     try:
-        # Insert vào bảng chính
-        cur.execute(f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES (%s, %s, %s)",
-                   (userid, itemid, rating))
-        
-        # Tính toán partition index
-        numberofpartitions = count_partitions(RANGE_TABLE_PREFIX, openconnection)
-        if numberofpartitions <= 0:
-            raise ValueError("No range partitions found")
-            
-        interval = 5.0 / numberofpartitions
-        
-        # Xác định partition dựa vào rating
-        target_partition = 0
-        
-        if rating == 0:
-            target_partition = 0
-        elif rating == 5.0:
-            target_partition = numberofpartitions - 1
-        else:
-            for i in range(numberofpartitions):
-                min_val = i * interval
-                max_val = (i + 1) * interval if i < numberofpartitions - 1 else 5.0
-                
-                if min_val < rating <= max_val:
-                    target_partition = i
-                    break
-        
-        # Insert vào partition tương ứng
-        table_name = f"{RANGE_TABLE_PREFIX}{target_partition}"
-        cur.execute(f"INSERT INTO {table_name} (userid, movieid, rating) VALUES (%s, %s, %s)",
-                   (userid, itemid, rating))
-        
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(f"Error in rangeinsert: {e}")
-        raise
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            data, rows = item
+            count += copy_ratings_data(cur, ratingstablename, data, rows, copy_format, freeze)
     finally:
-        cur.close()
-        log_execution_time("rangeinsert", start_time)
+        stop.set()
+        producer.join()
+    return count
 
-def create_db(dbname):
+
+def open_ratings_file(ratingsfilepath):
     """
-    We create a DB by connecting to the default user and database of Postgres
-    The function first checks if an existing database exists for a given name, else creates it.
-    :return:None
+    Opens @ratingsfilepath for reading lines, decompressing .gz, .bz2 and .xz files on the fly.
     """
-    start_time = time.time()
-    # Connect to the default database
-    con = getopenconnection(dbname='postgres')
-    con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-    cur = con.cursor()
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(ratingsfilepath)[1].lower())
+    if opener is None:
+        return open(ratingsfilepath, 'r')
+    return opener(ratingsfilepath, 'rt')
 
-    # Check if an existing database with the same name exists
-    cur.execute('SELECT COUNT(*) FROM pg_catalog.pg_database WHERE datname=\'%s\'' % (dbname,))
-    count = cur.fetchone()[0]
-    if count == 0:
-        cur.execute('CREATE DATABASE %s' % (dbname,))  # Create the database
-    else:
-        print('A database named {0} already exists'.format(dbname))
 
-    # Clean up
-    cur.close()
-    con.close()
-    log_execution_time("create_db", start_time)
+def copy_from_sql(tablename, copy_format='text', freeze=False):
+    """
+    COPY ... FROM STDIN statement for (userid, movieid, rating) rows in the tab-separated text or binary
+    @copy_format. @freeze adds FREEZE: the rows are written already frozen, which PostgreSQL only allows
+    when @tablename was created or truncated in the current transaction.
+    """
+    options = ["FORMAT binary" if copy_format == 'binary' else "DELIMITER E'\t'"]
+    if freeze:
+        options.append("FREEZE")
+    return f"COPY {tablename} (userid, movieid, rating) FROM STDIN WITH ({', '.join(options)})"
 
-def count_partitions(prefix, openconnection):
+
+def parse_ratings_lines(lines):
     """
-    Function to count the number of tables which have the @prefix in their name somewhere.
+    Yields (userid, movieid, rating) tuples for the `userid::movieid::rating::timestamp` @lines.
     """
-    start_time = time.time()
-    con = openconnection
-    cur = con.cursor()
-    cur.execute("select count(*) from pg_stat_user_tables where relname like " + "'" + prefix + "%';")
-    count = cur.fetchone()[0]
-    cur.close()
-    log_execution_time("count_partitions", start_time)
-    return count
+    for line in lines:
+        parts = line.strip().split('::')
+        if len(parts) >= 3:
+            yield int(parts[0]), int(parts[1]), float(parts[2])
 
-def get_rr_index():
-    """Get the current index for round robin insert"""
-    start_time = time.time()
-    try:
-        with open("rr_index.txt", 'r') as f:
-            index = int(f.read().strip())
-        log_execution_time("get_rr_index", start_time)
-        return index
-    except:
-        log_execution_time("get_rr_index", start_time)
+
+def encode_ratings_rows(rows):
+    """
+    Encodes (userid, movieid, rating) tuples as a complete PostgreSQL binary COPY stream.
+    """
+    pack = BINARY_COPY_ROW.pack
+    return b''.join([BINARY_COPY_HEADER] +
+                    [pack(3, 4, userid, 4, movieid, 8, rating) for userid, movieid, rating in rows] +
+                    [BINARY_COPY_TRAILER])
+
+
+def copy_ratings_batch(cur, ratingstablename, batch, freeze=False):
+    """
+    COPYs the list of (userid, movieid, rating) tuples @batch into @ratingstablename with one binary COPY.
+    """
+    with phase("copy", len(batch)):
+        cur.copy_expert(copy_from_sql(ratingstablename, 'binary', freeze), io.BytesIO(encode_ratings_rows(batch)))
+    return len(batch)
+
+
+def parse_ratings_block(data):
+    """
+    Vectorized parser for a uint8 NumPy view of whole `userid::movieid::rating[::timestamp]` lines.
+    Lines with fewer than three fields are skipped, like in copy_ratings_lines.
+    Returns (userid int32, movieid int32, rating float64) arrays.
+    """
+    newlines = np.flatnonzero(data == 10)
+    if len(newlines) == 0 or newlines[-1] != len(data) - 1:
+        # Dòng cuối file không có ký tự xuống dòng
+        newlines = np.append(newlines, len(data))
+    line_starts = np.concatenate(([0], newlines[:-1] + 1))
+    colon = data == 58
+    seps = np.flatnonzero(colon[:-1] & colon[1:])
+    # Hai phần tử chặn để seps[k + 2] luôn hợp lệ
+    seps = np.append(seps, [len(data), len(data)])
+    first = np.searchsorted(seps, line_starts)
+    keep = seps[np.minimum(first + 1, len(seps) - 1)] < newlines
+    first, line_starts, line_ends = first[keep], line_starts[keep], newlines[keep]
+    sep1, sep2, sep3 = seps[first], seps[first + 1], seps[first + 2]
+    userid = parse_number_fields(data, line_starts, sep1).astype(np.int64)
+    movieid = parse_number_fields(data, sep1 + 2, sep2).astype(np.int64)
+    rating = parse_number_fields(data, sep2 + 2, np.minimum(sep3, line_ends))
+    if len(userid) and max(userid.max(), movieid.max()) > 2**31 - 1:
+        raise ValueError("userid/movieid out of INTEGER range")
+    return userid.astype(np.int32), movieid.astype(np.int32), rating
+
+
+def parse_number_fields(data, starts, ends):
+    """
+    Parses the unsigned decimal fields data[starts[i]:ends[i]] (digits, an optional '.', surrounding
+    whitespace) into a float64 array. All fields are right-aligned into a fixed-width byte matrix and
+    read one column at a time (Horner's rule), so the work is a few array operations per character
+    position instead of Python code per row.
+    """
+    width = int((ends - starts).max()) if len(starts) else 0
+    if width > 18:
+        raise ValueError("Numeric field too long")
+    mantissa = np.zeros(len(starts), dtype=np.int64)
+    decimals = np.zeros(len(starts), dtype=np.int64)
+    seen_dot = np.zeros(len(starts), dtype=bool)
+    seen_digit = np.zeros(len(starts), dtype=bool)
+    for column in range(width):
+        index = ends - width + column
+        inside = index >= starts
+        chars = np.where(inside, data[np.maximum(index, 0)], 32)
+        digits = chars - 48
+        isdigit = digits <= 9
+        isdot = chars == 46
+        if not (isdigit | isdot | (chars == 32) | (chars == 9) | (chars == 13)).all() or (isdot & seen_dot).any():
+            raise ValueError("Malformed line, expected userid::movieid::rating::timestamp")
+        mantissa = np.where(isdigit, mantissa * 10 + digits, mantissa)
+        decimals += isdigit & seen_dot
+        seen_dot |= isdot
+        seen_digit |= isdigit
+    if not seen_digit.all():
+        raise ValueError("Malformed line, expected userid::movieid::rating::timestamp")
+    return mantissa / 10.0 ** decimals
+
+
+def parse_ratings_mmap(filepath, start=0, end=None, block_size=8 * 1024 * 1024):
+    """
+    Memory-maps @filepath and yields (userid, movieid, rating) arrays for the lines between byte
+    offsets @start and @end, parsing about @block_size bytes of whole lines at a time.
+    """
+    end = os.path.getsize(filepath) if end is None else end
+    if end <= start:
+        return
+    data = np.memmap(filepath, dtype=np.uint8, mode='r')
+    pos = start
+    while pos < end:
+        stop = min(pos + block_size, end)
+        if stop < end:
+            # Cắt block tại ký tự xuống dòng cuối cùng
+            # (hoặc dòng kế tiếp nếu dòng dài hơn block)
+            newlines = np.flatnonzero(data[pos:stop] == 10)
+            if len(newlines):
+                stop = pos + int(newlines[-1]) + 1
+            else:
+                newlines = np.flatnonzero(data[stop:end] == 10)
+                stop = stop + int(newlines[0]) + 1 if len(newlines) else end
+        yield parse_ratings_block(data[pos:stop].view(np.ndarray))
+        pos = stop
+
+
+def encode_ratings_binary(userid, movieid, rating):
+    """
+    Encodes column arrays as a complete PostgreSQL binary COPY stream of (INTEGER, INTEGER, FLOAT) rows.
+    """
+    rows = np.empty(len(userid), dtype=[
+        ('fields', '>i2'),
+        ('userid_len', '>i4'), ('userid', '>i4'),
+        ('movieid_len', '>i4'), ('movieid', '>i4'),
+        ('rating_len', '>i4'), ('rating', '>f8'),
+    ])
+    rows['fields'] = 3
+    rows['userid_len'] = 4
+    rows['userid'] = userid
+    rows['movieid_len'] = 4
+    rows['movieid'] = movieid
+    rows['rating_len'] = 8
+    rows['rating'] = rating
+    return BINARY_COPY_HEADER + rows.tobytes() + BINARY_COPY_TRAILER
+
+
+def copy_ratings_arrays(cur, ratingstablename, arrays, freeze=False):
+    """
+    COPYs each (userid, movieid, rating) tuple of arrays from @arrays into @ratingstablename with binary COPY.
+    Returns the number of copied rows.
+    """
+    count = 0
+    for userid, movieid, rating in timed_iter("parse", arrays, lambda arrays: len(arrays[0])):
+        if len(userid):
+            with phase("copy", len(userid)):
+                cur.copy_expert(copy_from_sql(ratingstablename, 'binary', freeze),
+                                io.BytesIO(encode_ratings_binary(userid, movieid, rating)))
+            count += len(userid)
+    return count
+
+
+def file_chunks(filepath, count):
+    """
+    Splits @filepath into at most @count (start, end) byte ranges that begin and end on line boundaries.
+    """
+    size = os.path.getsize(filepath)
+    offsets = [0]
+    with open(filepath, 'rb') as f:
+        for k in range(1, count):
+            target = size * k // count
+            if target <= offsets[-1]:
+                continue
+            # Lùi một byte để một dòng bắt đầu đúng tại target không bị bỏ qua
+            f.seek(target - 1)
+            f.readline()
+            if offsets[-1] < f.tell() < size:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if end > start]
+
+
+def read_chunk_lines(filepath, start, end, block_size=16 * 1024 * 1024):
+    """
+    Yields the lines of @filepath between byte offsets @start and @end, reading @block_size bytes at a time.
+    """
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        tail = b''
+        while remaining > 0:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                # File đã bị cắt ngắn sau khi file_chunks đo kích thước
+                raise ValueError(f"{filepath} ended {remaining} bytes before the end of its chunk")
+            block = tail + data
+            remaining -= len(data)
+            if remaining > 0:
+                # Giữ lại dòng bị cắt dở cho block sau
+                cut = block.rfind(b'\n') + 1
+                block, tail = block[:cut], block[cut:]
+            yield from block.decode().splitlines()
+
+
+def load_ratings_chunk(args):
+    """
+    Worker process for loadratings: copies one (start, end) byte range of the ratings file on its own
+    connection and commits it. Returns the number of copied rows.
+    """
+    connparams, ratingstablename, ratingsfilepath, start, end, parser, copy_format = args
+    conn = getopenconnection(**connparams)
+    try:
+        with conn.cursor() as cur:
+            if parser == 'mmap':
+                count = copy_ratings_arrays(cur, ratingstablename, parse_ratings_mmap(ratingsfilepath, start, end))
+            else:
+                count = copy_ratings_lines(cur, ratingstablename, read_chunk_lines(ratingsfilepath, start, end),
+                                           copy_format=copy_format)
+        conn.commit()
+        return count
+    finally:
+        conn.close()
+
+
+def load_ratings_parallel(ratingstablename, ratingsfilepath, openconnection, workers, parser='lines',
+                          copy_format='text'):
+    """
+    Loads @ratingsfilepath into the existing, committed @ratingstablename with @workers processes.
+    If any worker fails the table is truncated, so the load is all-or-nothing.
+    """
+    connparams = worker_connection_params(openconnection)
+    tasks = [(connparams, ratingstablename, ratingsfilepath, start, end, parser, copy_format)
+             for start, end in file_chunks(ratingsfilepath, workers)]
+    with multiprocessing.Pool(workers) as pool:
+        results = [pool.apply_async(load_ratings_chunk, (task,)) for task in tasks]
+        # Chờ tất cả worker kết thúc trước khi xử lý lỗi
+        errors = []
+        count = 0
+        for result in results:
+            try:
+                count += result.get()
+            except Exception as e:
+                errors.append(e)
+    if errors:
+        with openconnection.cursor() as cur:
+            cur.execute(f"TRUNCATE {ratingstablename}")
+        openconnection.commit()
+        raise errors[0]
+    return count
+
+
+def load_ratings_resumable(ratingstablename, ratingsfilepath, openconnection, copy_format='text',
+                           chunk_rows=RESUME_CHUNK_ROWS):
+    """
+    Loads @ratingsfilepath into @ratingstablename @chunk_rows lines at a time, committing each chunk together
+    with the byte offset reached in the load checkpoint table, so a failure only loses the chunk in progress.
+    A checkpoint left by an unfinished load of the same file (same path, size and modification time) is
+    resumed from its offset without touching the rows already committed; otherwise the table is recreated
+    and the load starts over. A finished load of the same file is not repeated. Concurrent calls for the same
+    table are serialized by an advisory lock held for the whole load. Returns the number of rows loaded by
+    this call.
+    """
+    stat = os.stat(ratingsfilepath)
+    source = (os.path.abspath(ratingsfilepath), stat.st_size, stat.st_mtime)
+    conn = openconnection
+    count = 0
+    with explicit_transactions(conn), conn.cursor() as cur:
+        # Khóa advisory cấp phiên giữ suốt lần tải (qua các lần commit từng chunk),
+        # nên hai lần tải cùng bảng không chạy song song; lần tải sau chờ rồi tiếp tục
+        # từ checkpoint của lần trước
+        lock_key = f"{LOAD_CHECKPOINTS}:{ratingstablename}"
+        cur.execute("SELECT pg_advisory_lock(hashtext(%s))", (lock_key,))
+        conn.commit()
+        try:
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {LOAD_CHECKPOINTS} (
+                    ratingstablename TEXT PRIMARY KEY,
+                    filepath TEXT NOT NULL,
+                    file_size BIGINT NOT NULL,
+                    file_mtime FLOAT8 NOT NULL,
+                    byte_offset BIGINT NOT NULL,
+                    rows BIGINT NOT NULL,
+                    done BOOLEAN NOT NULL
+                )
+            """)
+            cur.execute(f"""
+                SELECT filepath, file_size, file_mtime, byte_offset, done FROM {LOAD_CHECKPOINTS}
+                WHERE ratingstablename = %s
+            """, (ratingstablename,))
+            checkpoint = cur.fetchone()
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (ratingstablename,))
+            table_exists = cur.fetchone()[0]
+            if checkpoint is not None and tuple(checkpoint[:3]) == source and table_exists:
+                if checkpoint[4]:
+                    conn.commit()
+                    return 0
+                offset = checkpoint[3]
+            else:
+                # Lần tải mới: tạo lại bảng và đặt checkpoint về đầu file
+                offset = 0
+                cur.execute(f"""
+                    DROP TABLE IF EXISTS {ratingstablename};
+                    {create_ratings_table_sql(ratingstablename)};
+                """)
+                forget_routing(cur, ratingstablename)
+                cur.execute(f"""
+                    INSERT INTO {LOAD_CHECKPOINTS} (ratingstablename, filepath, file_size, file_mtime, byte_offset,
+                                                    rows, done)
+                    VALUES (%s, %s, %s, %s, 0, 0, false)
+                    ON CONFLICT (ratingstablename) DO UPDATE SET filepath = EXCLUDED.filepath,
+                        file_size = EXCLUDED.file_size, file_mtime = EXCLUDED.file_mtime, byte_offset = 0, rows = 0,
+                        done = false
+                """, (ratingstablename,) + source)
+            conn.commit()
+        
+            opener = COMPRESSED_OPENERS.get(os.path.splitext(ratingsfilepath)[1].lower(), open)
+            with opener(ratingsfilepath, 'rb') as f:
+                # Offset tính trên dữ liệu đã giải nén;
+                # file nén được giải nén lại tới vị trí đó
+                f.seek(offset)
+                lines = iter(f)
+                while True:
+                    chunk = list(islice(lines, chunk_rows))
+                    if not chunk:
+                        break
+                    offset += sum(map(len, chunk))
+                    copied = copy_ratings_lines(cur, ratingstablename, (line.decode() for line in chunk),
+                                                chunk_rows, copy_format)
+                    # Checkpoint được commit cùng transaction với dữ liệu của chunk
+                    cur.execute(f"""
+                        UPDATE {LOAD_CHECKPOINTS} SET byte_offset = %s, rows = rows + %s
+                        WHERE ratingstablename = %s
+                    """, (offset, copied, ratingstablename))
+                    with phase("loadratings.commit"):
+                        conn.commit()
+                    count += copied
+            cur.execute(f"UPDATE {LOAD_CHECKPOINTS} SET done = true WHERE ratingstablename = %s",
+                        (ratingstablename,))
+            conn.commit()
+        finally:
+            # Chunk dở dang (nếu có lỗi) bị hủy trước khi nhả khóa
+            if not conn.closed:
+                conn.rollback()
+                cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (lock_key,))
+                conn.commit()
+    return count
+
+
+@accepts_pool
+@timed("rangepartition")
+def rangepartition(ratingstablename, numberofpartitions, openconnection, method='loop', workers=4,
+                   backend='tables', boundaries='equal_width', sample_percent=None, bulk=None, indexes=None,
+                   routing='client'):
+    """
+    Function to create partitions of main table based on range of ratings.
+    @boundaries 'equal_width' splits [0, 5] into intervals of 5 / N, 'equi_depth' places the bounds at the
+    quantiles of the ratings histogram (of a TABLESAMPLE of @sample_percent percent of the rows if given), so that
+    the partitions hold about the same number of rows; a list gives the N - 1 upper bounds of partitions
+    0..N-2 directly. The bounds are stored in the partition catalog.
+    @method 'loop' fills each partition with its own INSERT ... SELECT, 'parallel' runs the same
+    statements concurrently over @workers extra connections, 'single_pass' reads the main table once
+    and lets PostgreSQL route every row to its partition.
+    With @backend 'declarative' the partitions are instead created as partitions of a parent table
+    PARTITION BY RANGE (rating), filled with one INSERT into the parent (@method is not used).
+    @bulk selects a fast bulk mode and @indexes the index stage, as in loadratings.
+    @routing 'trigger' installs a trigger on the main table that copies every later insert into its
+    partition (see install_routing_trigger); the insert functions then only write the main table.
+    """
+    conn = openconnection
+    cur = conn.cursor()
+    RANGE_TABLE_PREFIX = 'range_part'
+    
+    # Kiểm tra đầu vào
+    if not isinstance(numberofpartitions, int) or numberofpartitions <= 0:
+        raise ValueError("numberofpartitions must be a positive integer")
+    if method not in ('loop', 'parallel', 'single_pass'):
+        raise ValueError("method must be 'loop', 'parallel' or 'single_pass'")
+    if backend not in PARTITION_BACKENDS:
+        raise ValueError("backend must be 'tables' or 'declarative'")
+    check_bulk_mode(bulk, method, backend)
+    if routing not in ROUTING_MODES:
+        raise ValueError("routing must be 'client' or 'trigger'")
+    if isinstance(boundaries, (list, tuple)):
+        if len(boundaries) != numberofpartitions - 1 or list(boundaries) != sorted(boundaries):
+            raise ValueError("boundaries must be numberofpartitions - 1 ascending bounds")
+    elif boundaries not in ('equal_width', 'equi_depth'):
+        raise ValueError("boundaries must be 'equal_width', 'equi_depth' or a list of bounds")
+    
+    parent = partition_parent(ratingstablename, RANGE_TABLE_PREFIX)
+    tables = [f"{RANGE_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+    
+    with bulk_transaction(conn, bulk):
+        try:
+            # Tính toán khoảng phân vùng
+            if isinstance(boundaries, (list, tuple)):
+                bounds = [float(bound) for bound in boundaries]
+            elif boundaries == 'equi_depth':
+                bounds = equi_depth_bounds(rating_histogram(cur, ratingstablename, sample_percent), numberofpartitions)
+            else:
+                bounds = range_partition_bounds(numberofpartitions)
+            
+            # Xóa bảng cha của lần phân vùng declarative trước (kéo theo các partition của nó)
+            cur.execute(f"DROP TABLE IF EXISTS {parent}")
+            
+            # Xóa và tạo lại các bảng partition
+            for i in range(numberofpartitions):
+                table_name = f"{RANGE_TABLE_PREFIX}{i}"
+                cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+                if backend == 'tables':
+                    cur.execute(create_ratings_table_sql(table_name, bulk))
+            if backend == 'declarative':
+                create_range_parent(cur, parent, RANGE_TABLE_PREFIX, bounds)
+            
+            # Chế độ freeze giữ bảng mới tạo trong cùng transaction với dữ liệu
+            if bulk != 'freeze':
+                conn.commit()
+            
+            # Ghi cấu hình partition vào catalog, commit cùng với dữ liệu
+            layout = PartitionLayout('range', ratingstablename, numberofpartitions, bounds, backend, routing=routing)
+            save_partition_layout(cur, RANGE_TABLE_PREFIX, layout)
+            
+            with phase("rangepartition.fill") as fill:
+                if backend == 'declarative':
+                    # PostgreSQL chuyển từng dòng vào partition theo cận của bảng cha
+                    cur.execute(f"""
+                        INSERT INTO {parent} (userid, movieid, rating)
+                        SELECT userid, movieid, rating FROM {ratingstablename}
+                        WHERE rating >= 0 AND rating <= 5.0
+                    """)
+                    fill.rows = cur.rowcount
+                elif method == 'single_pass':
+                    # Đọc bảng chính một lần,
+                    # PostgreSQL tự chuyển từng dòng vào partition tương ứng
+                    fill.rows = route_range_partitions(cur, ratingstablename, RANGE_TABLE_PREFIX, bounds)
+                else:
+                    # Mỗi partition một câu INSERT ... SELECT:
+                    # phân vùng 0 bao gồm giá trị 0, phân vùng cuối bao gồm 5.0
+                    statements = [f"""
+                        INSERT INTO {RANGE_TABLE_PREFIX}{i} (userid, movieid, rating)
+                        SELECT userid, movieid, rating FROM {ratingstablename}
+                        WHERE {range_partition_predicate(i, bounds)}
+                    """ for i in range(numberofpartitions)]
+                
+                    if method == 'parallel':
+                        fill.rows = parallel_execute(conn, statements, workers)
+                    else:
+                        for statement in statements:
+                            cur.execute(statement)
+                            fill.rows += cur.rowcount
+            
+            install_routing_trigger(cur, RANGE_TABLE_PREFIX, layout)
+            finish_bulk_tables(cur, tables, bulk, analyze=not indexes)
+            with phase("rangepartition.commit"):
+                conn.commit()
+            
+            # Chỉ mục và thống kê được tạo sau khi dữ liệu đã ghi xong
+            index_stage(tables, conn, indexes, workers, brin=True)
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in rangepartition: {e}")
+            raise
+        finally:
+            cur.close()
+
+
+@accepts_pool
+@timed("roundrobinpartition")
+def roundrobinpartition(ratingstablename, numberofpartitions, openconnection, method='loop', workers=4,
+                        copy_format='text', backend='tables', bulk=None, indexes=None, routing='client'):
+    """
+    Function to create partitions of main table using round robin approach.
+    @method 'loop' numbers the main table once per partition with ROW_NUMBER(), 'parallel' runs the same
+    statements concurrently over @workers extra connections (sharing one snapshot and numbering the rows
+    in ctid order, so concurrent writes cannot make the workers disagree), 'single_pass' streams the main table out
+    once (as text or, with @copy_format 'binary', binary COPY) and deals the rows to the partitions
+    in scan order.
+    With @backend 'declarative' the partitions are instead created as partitions of a parent table
+    PARTITION BY LIST on a slot column whose default is the next round robin position, filled with one
+    INSERT into the parent (@method and @copy_format are not used).
+    @bulk selects a fast bulk mode and @indexes the index stage, as in loadratings.
+    @routing 'trigger' installs a trigger on the main table that copies every later insert into its
+    partition (see install_routing_trigger); the insert functions then only write the main table.
+    """
+    conn = openconnection
+    cur = conn.cursor()
+    RROBIN_TABLE_PREFIX = 'rrobin_part'
+    if method not in ('loop', 'parallel', 'single_pass'):
+        raise ValueError("method must be 'loop', 'parallel' or 'single_pass'")
+    if backend not in PARTITION_BACKENDS:
+        raise ValueError("backend must be 'tables' or 'declarative'")
+    check_bulk_mode(bulk, method, backend)
+    if routing not in ROUTING_MODES:
+        raise ValueError("routing must be 'client' or 'trigger'")
+    parent = partition_parent(ratingstablename, RROBIN_TABLE_PREFIX)
+    tables = [f"{RROBIN_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+    with bulk_transaction(conn, bulk):
+        try:
+            # Tạo tất cả bảng partition trong một câu lệnh, sau khi xóa bảng cha declarative cũ
+            create_tables_sql = [f"DROP TABLE IF EXISTS {parent}"]
+            for i in range(numberofpartitions):
+                create_tables_sql.append(f"DROP TABLE IF EXISTS {RROBIN_TABLE_PREFIX}{i}")
+                if backend == 'tables':
+                    create_tables_sql.append(create_ratings_table_sql(f"{RROBIN_TABLE_PREFIX}{i}", bulk))
+            
+            cur.execute(";".join(create_tables_sql))
+            if backend == 'declarative':
+                create_roundrobin_parent(cur, parent, RROBIN_TABLE_PREFIX, numberofpartitions)
+            # Chế độ freeze giữ bảng mới tạo trong cùng transaction với dữ liệu
+            if bulk != 'freeze':
+                conn.commit()
+            
+            # Ghi cấu hình partition vào catalog, commit cùng với dữ liệu
+            layout = PartitionLayout('roundrobin', ratingstablename, numberofpartitions, None, backend,
+                                     routing=routing)
+            save_partition_layout(cur, RROBIN_TABLE_PREFIX, layout)
+            
+            with phase("roundrobinpartition.fill") as fill:
+                if backend == 'declarative':
+                    # Dòng thứ k (tính từ 0) nhận slot k mod N,
+                    # PostgreSQL chuyển nó vào partition của slot
+                    cur.execute(f"""
+                        INSERT INTO {parent} (userid, movieid, rating, slot)
+                        SELECT userid, movieid, rating, (ROW_NUMBER() OVER() - 1) % {numberofpartitions}
+                        FROM {ratingstablename}
+                    """)
+                    total_rows = cur.rowcount
+                elif method == 'single_pass':
+                    # Một lần đọc: dòng thứ k (tính từ 0) vào partition k mod N
+                    total_rows = copy_route_partitions(
+                        cur,
+                        f"SELECT userid, movieid, rating FROM {ratingstablename}",
+                        RROBIN_TABLE_PREFIX,
+                        numberofpartitions,
+                        lambda line, rownum: rownum % numberofpartitions,
+                        copy_format,
+                        bulk == 'freeze'
+                    )
+                else:
+                    # Lấy tổng số dòng để tính partition
+                    cur.execute(f"SELECT COUNT(*) FROM {ratingstablename}")
+                    total_rows = cur.fetchone()[0]
+            
+                    # Nếu không có dòng, không cần phân vùng
+                    if total_rows == 0:
+                        reset_rr_index(cur, 0)
+                        install_routing_trigger(cur, RROBIN_TABLE_PREFIX, layout)
+                        finish_bulk_tables(cur, tables, bulk, analyze=not indexes)
+                        conn.commit()
+                        index_stage(tables, conn, indexes, workers)
+                        return
+            
+                    # Sử dụng INSERT với MOD để phân vùng dữ liệu.
+                    # Các worker song song đọc cùng một snapshot và đánh số theo ctid,
+                    # nên mọi worker thấy cùng các dòng theo cùng thứ tự
+                    order = "ORDER BY ctid" if method == 'parallel' else ""
+                    statements = [f"""
+                        INSERT INTO {RROBIN_TABLE_PREFIX}{i} (userid, movieid, rating)
+                        SELECT userid, movieid, rating 
+                        FROM (
+                            SELECT userid, movieid, rating, 
+                                   ROW_NUMBER() OVER({order}) AS rn 
+                            FROM {ratingstablename}
+                        ) t
+                        WHERE MOD(rn - 1, {numberofpartitions}) = {i}
+                    """ for i in range(numberofpartitions)]
+                
+                    if method == 'parallel':
+                        # Số dòng trong snapshot của các worker, dùng để đặt bộ đếm round robin
+                        total_rows = parallel_execute(conn, statements, workers, shared_snapshot=True)
+                    else:
+                        for statement in statements:
+                            cur.execute(statement)
+            
+                fill.rows = total_rows
+            
+            # Khởi tạo bộ đếm round robin trong database
+            reset_rr_index(cur, total_rows % numberofpartitions)
+            install_routing_trigger(cur, RROBIN_TABLE_PREFIX, layout)
+            finish_bulk_tables(cur, tables, bulk, analyze=not indexes)
+            with phase("roundrobinpartition.commit"):
+                conn.commit()
+            
+            # Chỉ mục và thống kê được tạo sau khi dữ liệu đã ghi xong
+            index_stage(tables, conn, indexes, workers, brin=False)
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in roundrobinpartition: {e}")
+            raise
+        finally:
+            cur.close()
+
+@accepts_pool
+@timed("roundrobininsert", rows=1)
+def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
+    """
+    Function to insert a new row into the main table and specific partition based on round robin approach.
+    Both writes are one prepared statement (see insert_statement), which takes the round robin position
+    from the database counter itself.
+    """
+    conn = openconnection
+    RROBIN_TABLE_PREFIX = 'rrobin_part'
+    
+    try:
+        layout = partition_layout(RROBIN_TABLE_PREFIX, openconnection)
+        if layout.partition_count <= 0:
+            raise ValueError("No round robin partitions found")
+        
+        # Một câu lệnh, một transaction:
+        # vị trí tiếp theo được lấy từ sequence trong cùng câu lệnh
+        execute_prepared(conn, insert_statement(ratingstablename, RROBIN_TABLE_PREFIX, layout),
+                         (userid, itemid, rating))
+    except Exception as e:
+        conn.rollback()
+        forget_prepared(conn)
+        invalidate_partition_cache(RROBIN_TABLE_PREFIX)
+        print(f"Error in roundrobininsert: {e}")
+        raise
+
+
+@accepts_pool
+@timed("rangeinsert", rows=1)
+def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
+    """
+    Function to insert a new row into the main table and specific partition based on range rating.
+    Both writes are one statement, prepared once per target partition (see insert_statement).
+    """
+    conn = openconnection
+    RANGE_TABLE_PREFIX = 'range_part'
+    
+    try:
+        # Tính toán partition index theo các cận lưu trong catalog
+        layout = partition_layout(RANGE_TABLE_PREFIX, openconnection)
+        if layout.partition_count <= 0:
+            raise ValueError("No range partitions found")
+        target_partition = range_partition_index(rating, layout.boundaries)
+        
+        # Insert vào bảng chính và partition tương ứng trong một câu lệnh
+        execute_prepared(conn, insert_statement(ratingstablename, RANGE_TABLE_PREFIX, layout, target_partition),
+                         (userid, itemid, rating))
+    except Exception as e:
+        conn.rollback()
+        forget_prepared(conn)
+        invalidate_partition_cache(RANGE_TABLE_PREFIX)
+        print(f"Error in rangeinsert: {e}")
+        raise
+
+@accepts_pool
+@timed("roundrobininsert_many", rows=lambda rows: rows)
+def roundrobininsert_many(ratingstablename, rows, openconnection):
+    """
+    Batch version of roundrobininsert for a list or iterator of (userid, movieid, rating) @rows.
+    The rows are dealt to the partitions in order, written with one COPY per table, and the round
+    robin counter advances by the batch size in one statement. Returns the number of inserted rows.
+    """
+    conn = openconnection
+    cur = conn.cursor()
+    RROBIN_TABLE_PREFIX = 'rrobin_part'
+    
+    try:
+        rows = [(int(userid), int(itemid), float(rating)) for userid, itemid, rating in rows]
+        
+        layout = partition_layout(RROBIN_TABLE_PREFIX, openconnection)
+        if layout.partition_count <= 0:
+            raise ValueError("No round robin partitions found")
+        
+        if layout.routing == 'trigger':
+            # Một COPY vào bảng chính, trigger chia các dòng vào partition
+            copy_ratings_batch(cur, ratingstablename, rows)
+        elif layout.backend == 'declarative':
+            copy_ratings_batch(cur, ratingstablename, rows)
+            copy_ratings_batch(cur, partition_parent(layout.ratingstablename, RROBIN_TABLE_PREFIX), rows)
+        else:
+            # Lấy vị trí cho cả batch trong một câu lệnh
+            groups = {}
+            for index, row in zip(next_rr_indexes(cur, len(rows)), rows):
+                groups.setdefault(index % layout.partition_count, []).append(row)
+            copy_partition_groups(cur, ratingstablename, RROBIN_TABLE_PREFIX, rows, groups)
+        
+        conn.commit()
+        return len(rows)
+    except Exception as e:
+        conn.rollback()
+        invalidate_partition_cache(RROBIN_TABLE_PREFIX)
+        print(f"Error in roundrobininsert_many: {e}")
+        raise
+    finally:
+        cur.close()
+
+
+@accepts_pool
+@timed("rangeinsert_many", rows=lambda rows: rows)
+def rangeinsert_many(ratingstablename, rows, openconnection):
+    """
+    Batch version of rangeinsert for a list or iterator of (userid, movieid, rating) @rows.
+    The rows are grouped by range partition and written with one COPY per table.
+    Returns the number of inserted rows.
+    """
+    conn = openconnection
+    cur = conn.cursor()
+    RANGE_TABLE_PREFIX = 'range_part'
+    
+    try:
+        rows = [(int(userid), int(itemid), float(rating)) for userid, itemid, rating in rows]
+        
+        layout = partition_layout(RANGE_TABLE_PREFIX, openconnection)
+        if layout.partition_count <= 0:
+            raise ValueError("No range partitions found")
+        
+        if layout.routing == 'trigger':
+            # Một COPY vào bảng chính, trigger chia các dòng vào partition
+            copy_ratings_batch(cur, ratingstablename, rows)
+        elif layout.backend == 'declarative':
+            copy_ratings_batch(cur, ratingstablename, rows)
+            copy_ratings_batch(cur, partition_parent(layout.ratingstablename, RANGE_TABLE_PREFIX), rows)
+        else:
+            groups = {}
+            for row in rows:
+                groups.setdefault(range_partition_index(row[2], layout.boundaries), []).append(row)
+            copy_partition_groups(cur, ratingstablename, RANGE_TABLE_PREFIX, rows, groups)
+        
+        conn.commit()
+        return len(rows)
+    except Exception as e:
+        conn.rollback()
+        invalidate_partition_cache(RANGE_TABLE_PREFIX)
+        print(f"Error in rangeinsert_many: {e}")
+        raise
+    finally:
+        cur.close()
+
+
+@accepts_pool
+@timed("hashpartition")
+def hashpartition(ratingstablename, numberofpartitions, openconnection, key='userid', method='loop', workers=4,
+                  backend='tables', bulk=None, indexes=None, routing='client'):
+    """
+    Function to create partitions of main table by hash of @key ('userid' or 'movieid'): a row goes to
+    partition key mod @numberofpartitions, so all ratings of one user (or movie) share a partition.
+    @method 'loop' fills each partition with its own INSERT ... SELECT, 'parallel' runs the same
+    statements concurrently over @workers extra connections.
+    With @backend 'declarative' the partitions are instead created as partitions of a parent table
+    PARTITION BY LIST on the same expression, filled with one INSERT into the parent (@method is not used).
+    @bulk selects a fast bulk mode and @indexes the index stage, as in loadratings.
+    @routing 'trigger' installs a trigger on the main table that copies every later insert into its
+    partition (see install_routing_trigger); the insert functions then only write the main table.
+    """
+    conn = openconnection
+    cur = conn.cursor()
+    HASH_TABLE_PREFIX = 'hash_part'
+    
+    # Kiểm tra đầu vào
+    if not isinstance(numberofpartitions, int) or numberofpartitions <= 0:
+        raise ValueError("numberofpartitions must be a positive integer")
+    if key not in ('userid', 'movieid'):
+        raise ValueError("key must be 'userid' or 'movieid'")
+    if method not in ('loop', 'parallel'):
+        raise ValueError("method must be 'loop' or 'parallel'")
+    if backend not in PARTITION_BACKENDS:
+        raise ValueError("backend must be 'tables' or 'declarative'")
+    check_bulk_mode(bulk, method, backend)
+    if routing not in ROUTING_MODES:
+        raise ValueError("routing must be 'client' or 'trigger'")
+    parent = partition_parent(ratingstablename, HASH_TABLE_PREFIX)
+    tables = [f"{HASH_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+    
+    with bulk_transaction(conn, bulk):
+        try:
+            # Xóa bảng cha của lần phân vùng declarative trước rồi tạo lại các partition
+            cur.execute(f"DROP TABLE IF EXISTS {parent}")
+            for i in range(numberofpartitions):
+                table_name = f"{HASH_TABLE_PREFIX}{i}"
+                cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+                if backend == 'tables':
+                    cur.execute(create_ratings_table_sql(table_name, bulk))
+            if backend == 'declarative':
+                create_hash_parent(cur, parent, HASH_TABLE_PREFIX, numberofpartitions, key)
+            
+            # Chế độ freeze giữ bảng mới tạo trong cùng transaction với dữ liệu
+            if bulk != 'freeze':
+                conn.commit()
+            
+            # Ghi cấu hình partition vào catalog, commit cùng với dữ liệu
+            layout = PartitionLayout('hash', ratingstablename, numberofpartitions, None, backend, key, routing)
+            save_partition_layout(cur, HASH_TABLE_PREFIX, layout)
+            
+            with phase("hashpartition.fill") as fill:
+                if backend == 'declarative':
+                    cur.execute(f"""
+                        INSERT INTO {parent} (userid, movieid, rating)
+                        SELECT userid, movieid, rating FROM {ratingstablename}
+                    """)
+                    fill.rows = cur.rowcount
+                else:
+                    statements = [f"""
+                        INSERT INTO {HASH_TABLE_PREFIX}{i} (userid, movieid, rating)
+                        SELECT userid, movieid, rating FROM {ratingstablename}
+                        WHERE {hash_partition_expression(key, numberofpartitions)} = {i}
+                    """ for i in range(numberofpartitions)]
+                
+                    if method == 'parallel':
+                        fill.rows = parallel_execute(conn, statements, workers)
+                    else:
+                        for statement in statements:
+                            cur.execute(statement)
+                            fill.rows += cur.rowcount
+            
+            install_routing_trigger(cur, HASH_TABLE_PREFIX, layout)
+            finish_bulk_tables(cur, tables, bulk, analyze=not indexes)
+            with phase("hashpartition.commit"):
+                conn.commit()
+            
+            # Chỉ mục và thống kê được tạo sau khi dữ liệu đã ghi xong
+            index_stage(tables, conn, indexes, workers, brin=False)
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in hashpartition: {e}")
+            raise
+        finally:
+            cur.close()
+
+
+@accepts_pool
+@timed("hashinsert", rows=1)
+def hashinsert(ratingstablename, userid, itemid, rating, openconnection):
+    """
+    Function to insert a new row into the main table and the hash partition of its userid or movieid.
+    Both writes are one statement, prepared once per target partition (see insert_statement).
+    """
+    conn = openconnection
+    HASH_TABLE_PREFIX = 'hash_part'
+    
+    try:
+        layout = partition_layout(HASH_TABLE_PREFIX, openconnection)
+        if layout.partition_count <= 0 or layout.partition_key is None:
+            raise ValueError("No hash partitions found")
+        keyvalue = userid if layout.partition_key == 'userid' else itemid
+        target_partition = hash_partition_index(keyvalue, layout.partition_count)
+        
+        execute_prepared(conn, insert_statement(ratingstablename, HASH_TABLE_PREFIX, layout, target_partition),
+                         (userid, itemid, rating))
+    except Exception as e:
+        conn.rollback()
+        forget_prepared(conn)
+        invalidate_partition_cache(HASH_TABLE_PREFIX)
+        print(f"Error in hashinsert: {e}")
+        raise
+
+
+class BufferedWriter:
+    """
+    Write-behind counterpart of rangeinsert / roundrobininsert / hashinsert: insert() queues a row, and the queue
+    is written to the main table and its current @scheme partitions in one transaction when it holds @max_rows
+    rows, when its oldest row has waited @max_delay seconds (None: no timer), or on flush() / close().
+    A failed flush keeps its rows queued. The writer holds @openconnection (or a pooled one) until close().
+    """
+    def __init__(self, ratingstablename, openconnection, scheme='range', max_rows=WRITE_BUFFER_ROWS,
+                 max_delay=WRITE_BUFFER_DELAY):
+        if scheme not in PARTITION_PREFIXES:
+            raise ValueError(f"Unknown partitioning scheme: {scheme}")
+        if max_rows < 1:
+            raise ValueError("max_rows must be at least 1")
+        self.ratingstablename = ratingstablename
+        self.scheme = scheme
+        self.prefix = PARTITION_PREFIXES[scheme]
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.pool = openconnection if isinstance(openconnection, ConnectionPool) else None
+        self.conn = self.pool.acquire() if self.pool is not None else openconnection
+        try:
+            if partition_layout(self.prefix, self.conn).partition_count <= 0:
+                raise ValueError(f"No {scheme} partitions found")
+        except Exception:
+            # Trả lại kết nối đã mượn,
+            # nếu không pool mất một chỗ sau mỗi lần khởi tạo lỗi
+            if self.pool is not None:
+                self.pool.release(self.conn)
+            raise
+        self.rows = []  # Hàng đợi cho bảng chính, theo thứ tự insert
+        self.queued_since = None  # Thời điểm dòng cũ nhất trong hàng đợi được thêm vào
+        self.error = None  # Lỗi của lần flush chạy nền gần nhất
+        self.closed = False
+        self.lock = threading.Lock()  # Bảo vệ hàng đợi
+        self.flush_lock = threading.Lock()  # Mỗi lúc chỉ một flush dùng kết nối
+        self.wakeup = threading.Event()
+        self.timer = None
+        if max_delay is not None:
+            self.timer = threading.Thread(target=self.run_timer, name="BufferedWriter", daemon=True)
+            self.timer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def insert(self, userid, itemid, rating):
+        """
+        Queues one row. Returns at once unless the queue is full and there is no timer thread,
+        in which case the queue is flushed first. The error of a failed background flush is raised
+        by the next call, after its row was queued.
+        """
+        row = (int(userid), int(itemid), float(rating))
+        with self.lock:
+            if self.closed:
+                raise ValueError("insert into a closed BufferedWriter")
+            self.rows.append(row)
+            if self.queued_since is None:
+                self.queued_since = time.monotonic()
+            full = len(self.rows) >= self.max_rows
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+        if full:
+            if self.timer is None:
+                self.flush()
+            else:
+                self.wakeup.set()
+
+    def flush(self):
+        """
+        Writes every queued row and commits. Returns the number of rows written.
+        """
+        with self.flush_lock:
+            with self.lock:
+                rows = self.rows
+                self.rows, self.queued_since = [], None
+            if not rows:
+                return 0
+            try:
+                with phase("BufferedWriter.flush", len(rows)):
+                    self.write(rows)
+            except Exception:
+                # Trả các dòng về đầu hàng đợi để lần flush sau ghi lại
+                with self.lock:
+                    self.rows = rows + self.rows
+                    self.queued_since = time.monotonic()
+                invalidate_partition_cache(self.prefix)
+                raise
+            return len(rows)
+
+    def write(self, rows):
+        conn = self.conn
+        # Tắt autocommit trong lúc flush để mọi COPY nằm trong một transaction
+        with explicit_transactions(conn), conn.cursor() as cur:
+            try:
+                # Đọc lại cấu hình mỗi lần flush:
+                # partition có thể đã được tạo lại từ khi dòng vào hàng đợi
+                layout = partition_layout(self.prefix, conn)
+                if layout.partition_count <= 0:
+                    raise ValueError(f"No {self.scheme} partitions found")
+                if layout.routing == 'trigger':
+                    copy_ratings_batch(cur, self.ratingstablename, rows)
+                elif layout.backend == 'declarative':
+                    copy_ratings_batch(cur, self.ratingstablename, rows)
+                    copy_ratings_batch(cur, partition_parent(layout.ratingstablename, self.prefix), rows)
+                else:
+                    groups = {}
+                    if self.scheme == 'roundrobin':
+                        for index, row in zip(next_rr_indexes(cur, len(rows)), rows):
+                            groups.setdefault(index % layout.partition_count, []).append(row)
+                    elif self.scheme == 'range':
+                        for row in rows:
+                            groups.setdefault(range_partition_index(row[2], layout.boundaries), []).append(row)
+                    else:
+                        for row in rows:
+                            keyvalue = row[0] if layout.partition_key == 'userid' else row[1]
+                            groups.setdefault(hash_partition_index(keyvalue, layout.partition_count), []).append(row)
+                    copy_partition_groups(cur, self.ratingstablename, self.prefix, rows, groups)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Error in BufferedWriter.flush: {e}")
+                raise
+
+    def run_timer(self):
+        while not self.closed:
+            with self.lock:
+                since = self.queued_since
+                full = len(self.rows) >= self.max_rows
+            if since is None:
+                timeout = self.max_delay
+            else:
+                timeout = since + self.max_delay - time.monotonic()
+            if full or (since is not None and timeout <= 0):
+                try:
+                    self.flush()
+                except Exception as e:
+                    with self.lock:
+                        self.error = e
+                    # Đợi hết khoảng trễ rồi mới thử lại
+                    self.wakeup.wait(self.max_delay)
+                    self.wakeup.clear()
+                continue
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def close(self):
+        """
+        Stops the timer thread, flushes the queue and gives a pooled connection back.
+        Returns the number of rows written by the final flush; if that flush fails the error is raised
+        and the rows still queued are not written.
+        """
+        with self.lock:
+            if self.closed:
+                return 0
+            self.closed = True
+            self.error = None  # Các dòng của flush nền bị lỗi vẫn nằm trong hàng đợi
+        self.wakeup.set()
+        if self.timer is not None:
+            self.timer.join()
+        try:
+            return self.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.release(self.conn)
+
+
+def hashquery(keyvalue, openconnection, fetch_size=QUERY_FETCH_SIZE):
+    """
+    Rows (userid, movieid, rating) of the user or movie @keyvalue (whichever key the hash partitions were
+    built on), read from the single hash_partN table that holds it and streamed like rangequery.
+    """
+    layout = partition_layout('hash_part', openconnection)
+    if layout.partition_count <= 0 or layout.partition_key is None:
+        raise ValueError("No hash partitions found")
+    table_name = f"hash_part{hash_partition_index(keyvalue, layout.partition_count)}"
+    query = f"SELECT userid, movieid, rating FROM {table_name} WHERE {layout.partition_key} = %(key)s"
+    return stream_query(openconnection, query, {'key': keyvalue}, fetch_size)
+
+
+@accepts_pool
+@timed("repartition", rows=lambda rows: rows)
+def repartition(scheme, numberofpartitions, openconnection):
+    """
+    Changes the number of @scheme ('range', 'roundrobin' or 'hash') partitions to @numberofpartitions in place,
+    moving only the rows whose partition changes, and returns the number of moved rows.
+    - range: the bounds are kept; growing splits the fullest intervals at their median rating, shrinking
+      merges the adjacent intervals with the fewest rows. Tables are renamed rather than copied.
+    - roundrobin: rows are moved from over-full to under-full partitions until the sizes are those of a
+      round robin deal over @numberofpartitions, and the counter continues from there.
+    - hash: rows whose key mod @numberofpartitions differs from their partition are moved.
+    Declarative partitions are rebuilt with the partition function instead, and all rows count as moved;
+    range bounds are resized the same way. In both cases the single-column indexes of the old partitions
+    are built on the new ones.
+    """
+    conn = openconnection
+    prefix = tables_prefix(scheme)
+    
+    # Kiểm tra đầu vào
+    if not isinstance(numberofpartitions, int) or numberofpartitions <= 0:
+        raise ValueError("numberofpartitions must be a positive integer")
+    layout = partition_layout(prefix, openconnection)
+    if layout.partition_count <= 0 or layout.ratingstablename is None:
+        raise ValueError(f"No {scheme} partitions found")
+    
+    with conn.cursor() as cur:
+        indexes = index_options(cur, f"{prefix}0")
+    
+    if layout.backend == 'declarative':
+        if scheme == 'range':
+            parent = partition_parent(layout.ratingstablename, prefix)
+            with conn.cursor() as cur:
+                histogram = rating_histogram(cur, parent)
+                # Dòng có rating ngoài [0, 5] chỉ nằm trong partition 0 (rangepartition không
+                # lấy chúng từ bảng chính): giữ lại qua lần dựng lại, như repartition_range
+                cur.execute(f"""
+                    DROP TABLE IF EXISTS {parent}_outside;
+                    CREATE TEMP TABLE {parent}_outside AS
+                    SELECT userid, movieid, rating FROM {prefix}0 WHERE NOT (rating >= 0 AND rating <= 5.0)
+                """)
+            rangepartition(layout.ratingstablename, numberofpartitions, conn, backend='declarative',
+                           boundaries=resize_range_bounds(layout.boundaries, histogram, numberofpartitions),
+                           indexes=indexes, routing=layout.routing)
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    INSERT INTO {parent} (userid, movieid, rating) SELECT userid, movieid, rating FROM {parent}_outside;
+                    DROP TABLE {parent}_outside
+                """)
+            conn.commit()
+        elif scheme == 'roundrobin':
+            roundrobinpartition(layout.ratingstablename, numberofpartitions, conn, backend='declarative',
+                                indexes=indexes, routing=layout.routing)
+        else:
+            hashpartition(layout.ratingstablename, numberofpartitions, conn, key=layout.partition_key,
+                          backend='declarative', indexes=indexes, routing=layout.routing)
+        moved = sum(rows for _, rows in partition_row_counts(scheme, conn))
+        return moved
+    
+    # Các bảng tạm ON COMMIT DROP và việc chuyển dòng cần một transaction kể cả khi autocommit bật
+    with explicit_transactions(conn):
+        cur = conn.cursor()
+        try:
+            if scheme == 'range':
+                moved, bounds = repartition_range(cur, prefix, layout.boundaries, numberofpartitions)
+            elif scheme == 'roundrobin':
+                moved, bounds = repartition_roundrobin(cur, prefix, layout.partition_count, numberofpartitions), None
+            else:
+                moved, bounds = repartition_hash(cur, prefix, layout.partition_count, numberofpartitions,
+                                                 layout.partition_key), None
+            layout = layout._replace(partition_count=numberofpartitions, boundaries=bounds)
+            save_partition_layout(cur, prefix, layout)
+            # Hàm trigger sinh lại theo số partition mới
+            install_routing_trigger(cur, prefix, layout)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            invalidate_partition_cache(prefix)
+            print(f"Error in repartition: {e}")
+            raise
+        finally:
+            cur.close()
+    
+    # Bảng partition mới nhận các chỉ mục của bảng cũ
+    index_stage([f"{prefix}{i}" for i in range(numberofpartitions)], conn, indexes, workers=4)
+    return moved
+
+
+def rangequery(ratingminvalue, ratingmaxvalue, openconnection, scheme='range', fetch_size=QUERY_FETCH_SIZE):
+    """
+    Rows (userid, movieid, rating) of the partitions with @ratingminvalue <= rating <= @ratingmaxvalue.
+    With scheme='range' only the range_partN tables whose interval overlaps the predicate are read,
+    with scheme='roundrobin' the query fans out to every rrobin_partN table. Declarative partitions are
+    queried through their parent table and pruned by PostgreSQL.
+    The rows are streamed from a server-side cursor, @fetch_size at a time; @openconnection must stay
+    open (and must not be a ConnectionPool) until the iterator is exhausted or closed.
+    """
+    tables = query_partition_tables(scheme, ratingminvalue, ratingmaxvalue, openconnection)
+    layout = partition_layout(tables_prefix(scheme), openconnection)
+    if tables and layout.backend == 'declarative':
+        tables = [partition_parent(layout.ratingstablename, tables_prefix(scheme))]
+    query = " UNION ALL ".join(
+        f"SELECT userid, movieid, rating FROM {table} WHERE rating >= %(lo)s AND rating <= %(hi)s"
+        for table in tables)
+    return stream_query(openconnection, query, {'lo': ratingminvalue, 'hi': ratingmaxvalue}, fetch_size)
+
+
+def pointquery(ratingvalue, openconnection, scheme='range', fetch_size=QUERY_FETCH_SIZE):
+    """
+    Rows (userid, movieid, rating) of the partitions with rating = @ratingvalue, streamed like rangequery.
+    With scheme='range' a single range_partN table is read.
+    """
+    return rangequery(ratingvalue, ratingvalue, openconnection, scheme=scheme, fetch_size=fetch_size)
+
+
+def partition_row_counts(scheme, openconnection):
+    """
+    Report of the @scheme partitions: a list of (table name, number of rows) in partition order.
+    """
+    prefix = tables_prefix(scheme)
+    tables = [f"{prefix}{i}" for i in range(partition_layout(prefix, openconnection).partition_count)]
+    if not tables:
+        raise ValueError(f"No {scheme} partitions found")
+    cur = openconnection.cursor()
+    cur.execute(" UNION ALL ".join(f"SELECT {i}, COUNT(*) FROM {table}" for i, table in enumerate(tables))
+                + " ORDER BY 1")
+    counts = [(tables[i], count) for i, count in cur.fetchall()]
+    cur.close()
+    return counts
+
+
+def tables_prefix(scheme):
+    """
+    Table name prefix of the partitions of @scheme ('range', 'roundrobin' or 'hash').
+    """
+    if scheme not in PARTITION_PREFIXES:
+        raise ValueError(f"Unknown partitioning scheme: {scheme}")
+    return PARTITION_PREFIXES[scheme]
+
+
+def query_partition_tables(scheme, ratingminvalue, ratingmaxvalue, openconnection):
+    """
+    Names of the @scheme ('range', 'roundrobin' or 'hash') partitions a query on
+    @ratingminvalue <= rating <= @ratingmaxvalue has to read: the overlapping ones for range partitions, all of them
+    for round robin and hash partitions.
+    """
+    prefix = tables_prefix(scheme)
+    layout = partition_layout(prefix, openconnection)
+    if layout.partition_count <= 0:
+        raise ValueError(f"No {scheme} partitions found")
+    if scheme == 'range':
+        partitions = range_query_partitions(ratingminvalue, ratingmaxvalue, layout.boundaries)
+        last = layout.partition_count - 1
+        if layout.backend == 'declarative' and ratingmaxvalue > 5.0 and last not in partitions:
+            # Bảng cha declarative xếp rating > 5 vào partition cuối
+            partitions.append(last)
+    else:
+        partitions = range(layout.partition_count) if ratingminvalue <= ratingmaxvalue else []
+    return [f"{prefix}{i}" for i in partitions]
+
+
+@timed("stream_query")
+def stream_query(openconnection, query, params, fetch_size):
+    """
+    Iterates over the rows of @query through a named (server-side) cursor. An empty @query yields nothing.
+    In autocommit mode a transaction is kept open for the life of the iterator (a WITH HOLD cursor would
+    compute the whole result before the first row), and committed when it ends; the connection should not
+    be used for other work in the meantime.
+    """
+    if not query:
+        return
+    autocommit = openconnection.autocommit
+    # psycopg2 >= 2.9 mở transaction trong khối `with conn:` kể cả khi autocommit bật, và không cho đổi
+    # autocommit giữa transaction: cursor WITH HOLD chỉ được tính hết khi transaction đó commit
+    held = autocommit and openconnection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    with explicit_transactions(openconnection):
+        cur = openconnection.cursor(name=f"rating_query_{uuid.uuid4().hex}", withhold=held)
+        cur.itersize = fetch_size
+        try:
+            cur.execute(query, params)
+            yield from cur
+        finally:
+            cur.close()
+            if autocommit and not held:
+                openconnection.commit()
+
+
+def scatter_gather(openconnection, tables, query, params=None, workers=POOL_SIZE):
+    """
+    Runs @query, a template with a {table} placeholder, against every one of @tables at once, over up to @workers
+    pooled connections to the database of @openconnection, and returns the rows of each table in @tables order.
+    Every partition is read in its own transaction, so concurrent writes may be seen by some partitions only.
+    """
+    if not tables:
+        return []
+    workers = max(1, min(workers, len(tables)))
+    pool = worker_pool(openconnection, workers)
+
+    def run(table):
+        with pool.connection() as wconn, wconn.cursor() as wcur:
+            wcur.execute(query.format(table=table), params)
+            return wcur.fetchall()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, tables))
+
+
+@timed("count_ratings")
+def count_ratings(openconnection, scheme='roundrobin', ratingminvalue=float('-inf'), ratingmaxvalue=float('inf'),
+                  workers=POOL_SIZE):
+    """
+    Number of rows with @ratingminvalue <= rating <= @ratingmaxvalue, counted in parallel on the @scheme partitions
+    (pruned for range partitions) and summed on the client.
+    """
+    tables = query_partition_tables(scheme, ratingminvalue, ratingmaxvalue, openconnection)
+    partials = scatter_gather(openconnection, tables, """
+        SELECT COUNT(*) FROM {table} WHERE rating >= %(lo)s AND rating <= %(hi)s
+    """, {'lo': ratingminvalue, 'hi': ratingmaxvalue}, workers)
+    return sum(rows[0][0] for rows in partials)
+
+
+def movie_rating_totals(openconnection, scheme, ratingminvalue, ratingmaxvalue, workers):
+    """
+    movieid -> [sum of ratings, number of ratings], merged from the per-partition SUM/COUNT partial aggregates.
+    """
+    tables = query_partition_tables(scheme, ratingminvalue, ratingmaxvalue, openconnection)
+    partials = scatter_gather(openconnection, tables, """
+        SELECT movieid, SUM(rating), COUNT(*) FROM {table}
+        WHERE rating >= %(lo)s AND rating <= %(hi)s
+        GROUP BY movieid
+    """, {'lo': ratingminvalue, 'hi': ratingmaxvalue}, workers)
+    totals = {}
+    for rows in partials:
+        for movieid, total, count in rows:
+            merged = totals.get(movieid)
+            if merged is None:
+                totals[movieid] = [total, count]
+            else:
+                merged[0] += total
+                merged[1] += count
+    return totals
+
+
+@timed("movie_average_ratings")
+def movie_average_ratings(openconnection, scheme='roundrobin', ratingminvalue=float('-inf'),
+                          ratingmaxvalue=float('inf'), workers=POOL_SIZE):
+    """
+    movieid -> average rating, computed from SUM and COUNT pushed down to every @scheme partition in parallel.
+    """
+    totals = movie_rating_totals(openconnection, scheme, ratingminvalue, ratingmaxvalue, workers)
+    return {movieid: total / count for movieid, (total, count) in totals.items()}
+
+
+@timed("top_movies")
+def top_movies(k, openconnection, scheme='roundrobin', min_count=1, ratingminvalue=float('-inf'),
+               ratingmaxvalue=float('inf'), workers=POOL_SIZE):
+    """
+    The @k movies with the highest average rating among those with at least @min_count ratings,
+    as (movieid, average, count) tuples, best first (ties broken by count, then by lowest movieid).
+    The partial SUM/COUNT of every partition are merged and the top @k selected with a heap.
+    """
+    totals = movie_rating_totals(openconnection, scheme, ratingminvalue, ratingmaxvalue, workers)
+    top = heapq.nlargest(k, ((total / count, count, -movieid) for movieid, (total, count) in totals.items()
+                             if count >= min_count))
+    return [(-negmovieid, average, count) for average, count, negmovieid in top]
+
+@timed("create_db")
+def create_db(dbname):
+    """
+    We create a DB by connecting to the default user and database of Postgres
+    The function first checks if an existing database exists for a given name, else creates it.
+    :return:None
+    """
+    # Database đã được kiểm tra trong tiến trình này thì bỏ qua round trip tới server
+    if dbname in CREATED_DATABASES:
+        return
+    
+    # Connect to the default database
+    con = getopenconnection(dbname='postgres')
+    con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cur = con.cursor()
+
+    # Check if an existing database with the same name exists
+    cur.execute('SELECT COUNT(*) FROM pg_catalog.pg_database WHERE datname=\'%s\'' % (dbname,))
+    count = cur.fetchone()[0]
+    if count == 0:
+        cur.execute('CREATE DATABASE %s' % (dbname,))  # Create the database
+    else:
+        print('A database named {0} already exists'.format(dbname))
+
+    CREATED_DATABASES.add(dbname)
+
+    # Clean up
+    cur.close()
+    con.close()
+
+@timed("count_partitions")
+def count_partitions(prefix, openconnection):
+    """
+    Function to count the number of tables which have the @prefix in their name somewhere.
+    """
+    con = openconnection
+    cur = con.cursor()
+    cur.execute("select count(*) from pg_stat_user_tables where relname like " + "'" + prefix + "%';")
+    count = cur.fetchone()[0]
+    cur.close()
+    return count
+
+def save_partition_layout(cur, prefix, layout):
+    """
+    Records the @layout of the @prefix partitions in the partition catalog (in the caller's transaction)
+    and drops the cached copy, so the next lookup reads the new layout.
+    """
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {PARTITION_CATALOG} (
+            prefix TEXT PRIMARY KEY,
+            scheme TEXT NOT NULL,
+            ratingstablename TEXT NOT NULL,
+            partition_count INTEGER NOT NULL,
+            boundaries FLOAT8[]
+        );
+        ALTER TABLE {PARTITION_CATALOG} ADD COLUMN IF NOT EXISTS backend TEXT NOT NULL DEFAULT 'tables';
+        ALTER TABLE {PARTITION_CATALOG} ADD COLUMN IF NOT EXISTS partition_key TEXT;
+        ALTER TABLE {PARTITION_CATALOG} ADD COLUMN IF NOT EXISTS routing TEXT NOT NULL DEFAULT 'client';
+    """)
+    cur.execute(f"""
+        INSERT INTO {PARTITION_CATALOG} (prefix, scheme, ratingstablename, partition_count, boundaries, backend,
+                                         partition_key, routing)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (prefix) DO UPDATE SET scheme = EXCLUDED.scheme, ratingstablename = EXCLUDED.ratingstablename,
+            partition_count = EXCLUDED.partition_count, boundaries = EXCLUDED.boundaries, backend = EXCLUDED.backend,
+            partition_key = EXCLUDED.partition_key, routing = EXCLUDED.routing
+    """, (prefix, layout.scheme, layout.ratingstablename, layout.partition_count, layout.boundaries,
+          layout.backend, layout.partition_key, layout.routing))
+    invalidate_partition_cache(prefix)
+
+
+def partition_layout(prefix, openconnection):
+    """
+    PartitionLayout of the @prefix partitions. Served from the in-process cache; on a miss it is read from
+    the partition catalog, or, for partitions built without one, derived from count_partitions.
+    Only rebuilds made by this process clear the cache: after another process rebuilds or repartitions,
+    call invalidate_partition_cache(), or the client-side insert functions keep routing rows with the old
+    partition count and bounds. Declarative partitions and routing='trigger' are routed by PostgreSQL and
+    only rely on the cached backend and routing mode.
+    """
+    key = (openconnection.dsn, prefix)
+    layout = PARTITION_CACHE.get(key)
+    if layout is None:
+        cur = openconnection.cursor()
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (PARTITION_CATALOG,))
+        row = None
+        if cur.fetchone()[0]:
+            # SELECT * để đọc được cả catalog tạo trước khi có cột backend
+            cur.execute(f"SELECT * FROM {PARTITION_CATALOG} WHERE prefix = %s", (prefix,))
+            row = cur.fetchone()
+            if row is not None:
+                row = dict(zip((column.name for column in cur.description), row))
+        cur.close()
+        if row is not None:
+            layout = PartitionLayout(**{field: row[field] for field in PartitionLayout._fields if field in row})
+        else:
+            # Partition được tạo trước khi có catalog: đếm bảng như cũ
+            count = count_partitions(prefix, openconnection)
+            scheme = next((scheme for scheme, p in PARTITION_PREFIXES.items() if p == prefix), None)
+            layout = PartitionLayout(scheme, None, count,
+                                     range_partition_bounds(count) if count > 0 else [])
+            if count <= 0:
+                return layout
+            if scheme == 'roundrobin' and not seed_rr_index(prefix, count, openconnection):
+                # Bộ đếm chỉ có trong transaction của người gọi: không lưu cache,
+                # để lần tra cứu sau tạo lại nó nếu transaction bị hủy
+                return layout
+        PARTITION_CACHE[key] = layout
+    return layout
+
+
+def invalidate_partition_cache(prefix=None):
+    """
+    Forgets the cached layout of the @prefix partitions (of all partitions if @prefix is None).
+    """
+    for key in list(PARTITION_CACHE):
+        if prefix is None or key[1] == prefix:
+            del PARTITION_CACHE[key]
+
+
+def range_partition_bounds(numberofpartitions):
+    """
+    Upper bounds of range partitions 0..n-2, identical to the ones used by rangepartition.
+    Partition 0 is [0, bounds[0]], partition i is (bounds[i-1], bounds[i]] and the last one ends at 5.0,
+    so a rating in [0, 5] belongs to partition bisect_left(bounds, rating).
+    """
+    interval = 5.0 / numberofpartitions
+    return [(i + 1) * interval for i in range(numberofpartitions - 1)]
+
+
+def rating_histogram(cur, ratingstablename, sample_percent=None):
+    """
+    List of (rating, number of rows) for the ratings in [0, 5] of @ratingstablename, in rating order.
+    With @sample_percent only that percentage of the table's pages is read (TABLESAMPLE SYSTEM).
+    """
+    sample = f"TABLESAMPLE SYSTEM ({float(sample_percent)})" if sample_percent is not None else ""
+    cur.execute(f"""
+        SELECT rating, COUNT(*) FROM {ratingstablename} {sample}
+        WHERE rating >= 0 AND rating <= 5.0
+        GROUP BY rating ORDER BY rating
+    """)
+    return cur.fetchall()
+
+
+def equi_depth_bounds(histogram, numberofpartitions):
+    """
+    Upper bounds of range partitions 0..n-2 splitting the rows of @histogram ((rating, rows) in rating order)
+    as evenly as whole rating values allow, with at least one distinct rating per partition while there are
+    enough of them. Falls back to range_partition_bounds for an empty histogram.
+    """
+    if not histogram:
+        return range_partition_bounds(numberofpartitions)
+    values = [rating for rating, _ in histogram]
+    cumulative = []
+    total = 0
+    for _, count in histogram:
+        total += count
+        cumulative.append(total)
+    
+    bounds = []
+    previous = -1
+    for i in range(1, numberofpartitions):
+        target = total * i / numberofpartitions
+        k = bisect_left(cumulative, target)
+        if k > 0 and (k == len(values) or target - cumulative[k - 1] <= cumulative[k] - target):
+            k -= 1
+        # Chừa lại ít nhất một giá trị rating cho mỗi partition phía sau nếu còn đủ
+        k = max(min(k, len(values) - 1 - (numberofpartitions - i)), previous + 1)
+        if k < len(values):
+            bounds.append(float(values[k]))
+            previous = k
+        else:
+            # Giá trị rating đã dùng hết: partition rỗng (bounds[-1], nextafter(bounds[-1])]
+            bounds.append(math.nextafter(bounds[-1], math.inf))
+    return bounds
+
+
+def range_partition_index(rating, bounds):
+    """
+    Range partition of @rating for the given @bounds. Ratings outside [0, 5] go to partition 0, like in rangeinsert.
+    """
+    if not 0 <= rating <= 5.0:
         return 0
+    return bisect_left(bounds, rating)
+
+
+def range_query_partitions(ratingminvalue, ratingmaxvalue, bounds):
+    """
+    Indexes of the range partitions for the given @bounds that can hold ratings in [@ratingminvalue, @ratingmaxvalue].
+    Partition 0 also holds the ratings outside [0, 5], so it is kept whenever the interval reaches outside them.
+    """
+    if ratingminvalue > ratingmaxvalue:
+        return []
+    partitions = []
+    if ratingminvalue <= 5.0 and ratingmaxvalue >= 0:
+        first = range_partition_index(max(ratingminvalue, 0.0), bounds)
+        last = range_partition_index(min(ratingmaxvalue, 5.0), bounds)
+        partitions = list(range(first, last + 1))
+    if (ratingminvalue < 0 or ratingmaxvalue > 5.0) and 0 not in partitions:
+        partitions.insert(0, 0)
+    return partitions
+
+
+def hash_partition_index(keyvalue, numberofpartitions):
+    """
+    Hash partition of a userid or movieid @keyvalue. Python's % is never negative for a positive divisor.
+    """
+    return int(keyvalue) % numberofpartitions
+
+
+def hash_partition_expression(key, numberofpartitions):
+    """
+    SQL expression computing hash_partition_index of column @key (SQL % keeps the sign of the dividend).
+    """
+    return f"(({key} % {numberofpartitions}) + {numberofpartitions}) % {numberofpartitions}"
+
+
+def range_partition_predicate(index, bounds):
+    """
+    SQL condition on rating selecting the rows of range partition @index for the given @bounds.
+    """
+    lower = "rating >= 0" if index == 0 else f"rating > {bounds[index - 1]}"
+    upper = f"rating <= {bounds[index]}" if index < len(bounds) else "rating <= 5.0"
+    return f"{lower} AND {upper}"
+
+
+def route_range_partitions(cur, ratingstablename, prefix, bounds):
+    """
+    Fill @prefix<i> from @ratingstablename with a single scan. The (empty) partitions are attached for the
+    duration of the statement to a parent partitioned by RANGE (-rating), so PostgreSQL routes every row
+    itself: partition i receives (bounds[i-1], bounds[i]], partition 0 includes 0 and the last ends at 5.0.
+    Returns the number of routed rows.
+    """
+    numberofpartitions = len(bounds) + 1
+    router = f"{ratingstablename}_range_router"
+    cur.execute(f"""
+        DROP TABLE IF EXISTS {router};
+        CREATE TABLE {router} (userid INTEGER, movieid INTEGER, rating FLOAT) PARTITION BY RANGE ((-rating));
+    """)
+    for i in range(numberofpartitions):
+        # Khóa là -rating nên khoảng [from, to) của PostgreSQL trở thành (lo, hi] trên rating
+        lower = f"({-bounds[i]!r})" if i < numberofpartitions - 1 else "(MINVALUE)"
+        upper = f"({-bounds[i - 1]!r})" if i > 0 else "(MAXVALUE)"
+        cur.execute(f"ALTER TABLE {router} ATTACH PARTITION {prefix}{i} FOR VALUES FROM {lower} TO {upper}")
+    cur.execute(f"""
+        INSERT INTO {router} (userid, movieid, rating)
+        SELECT userid, movieid, rating FROM {ratingstablename}
+        WHERE rating >= 0 AND rating <= 5.0
+    """)
+    rows = cur.rowcount
+    for i in range(numberofpartitions):
+        cur.execute(f"ALTER TABLE {router} DETACH PARTITION {prefix}{i}")
+    cur.execute(f"DROP TABLE {router}")
+    return rows
+
+
+def partition_parent(ratingstablename, prefix):
+    """
+    Name of the parent table of the declarative @prefix partitions of @ratingstablename.
+    It must not start with @prefix, or count_partitions would count it as a partition.
+    """
+    return f"{ratingstablename}_{prefix}s"
+
+
+def create_range_parent(cur, parent, prefix, bounds):
+    """
+    Creates @parent PARTITION BY RANGE (rating) with @prefix<i> as partition i for the given @bounds.
+    PostgreSQL ranges are [from, to), so the bounds are moved to the next float8 up to get (bounds[i-1], bounds[i]].
+    Partition 0 is the DEFAULT partition, so like in range_partition_index it also holds the ratings outside
+    [0, 5]. A partition whose interval lies above 5.0 can never receive a row and is left unattached.
+    """
+    numberofpartitions = len(bounds) + 1
+    cur.execute(f"""
+        CREATE TABLE {parent} (userid INTEGER, movieid INTEGER, rating FLOAT) PARTITION BY RANGE (rating)
+    """)
+    cur.execute(f"CREATE TABLE {prefix}0 PARTITION OF {parent} DEFAULT")
+    top = math.nextafter(5.0, math.inf)
+    for i in range(1, numberofpartitions):
+        lower = math.nextafter(bounds[i - 1], math.inf)
+        upper = min(math.nextafter(bounds[i], math.inf), top) if i < numberofpartitions - 1 else top
+        if lower < upper:
+            cur.execute(f"CREATE TABLE {prefix}{i} PARTITION OF {parent} FOR VALUES FROM ({lower!r}) TO ({upper!r})")
+        else:
+            cur.execute(f"CREATE TABLE {prefix}{i} (userid INTEGER, movieid INTEGER, rating FLOAT)")
+
+
+def create_hash_parent(cur, parent, prefix, numberofpartitions, key):
+    """
+    Creates @parent PARTITION BY LIST on hash_partition_expression(@key) with @prefix<i> holding hash value i.
+    """
+    cur.execute(f"""
+        CREATE TABLE {parent} (userid INTEGER, movieid INTEGER, rating FLOAT)
+        PARTITION BY LIST (({hash_partition_expression(key, numberofpartitions)}))
+    """)
+    for i in range(numberofpartitions):
+        cur.execute(f"CREATE TABLE {prefix}{i} PARTITION OF {parent} FOR VALUES IN ({i})")
+
+
+def create_roundrobin_parent(cur, parent, prefix, numberofpartitions):
+    """
+    Creates @parent PARTITION BY LIST (slot) with @prefix<i> holding slot i. A generated column cannot be a
+    partition key, so slot defaults to the next value of the round robin counter mod @numberofpartitions:
+    an INSERT into @parent without slot goes to the next partition in turn.
+    """
+    reset_rr_index(cur, 0)
+    cur.execute(f"""
+        CREATE TABLE {parent} (
+            userid INTEGER, movieid INTEGER, rating FLOAT,
+            slot INTEGER NOT NULL DEFAULT (nextval('{RROBIN_INDEX_SEQUENCE}') % {numberofpartitions})
+        ) PARTITION BY LIST (slot)
+    """)
+    for i in range(numberofpartitions):
+        cur.execute(f"CREATE TABLE {prefix}{i} PARTITION OF {parent} FOR VALUES IN ({i})")
+
+
+def install_routing_trigger(cur, prefix, layout):
+    """
+    Installs the routing trigger of the @prefix partitions on the main table if @layout.routing is 'trigger',
+    after removing any previous one. It is a statement-level AFTER INSERT trigger whose function is generated
+    from @layout: every INSERT or COPY into the main table also writes its rows to their partitions, with
+    one statement per partition over the transition table.
+    """
+    function = f"{prefix}_route"
+    cur.execute(f"DROP FUNCTION IF EXISTS {function}() CASCADE")
+    if layout.routing != 'trigger':
+        return
+    cur.execute(f"""
+        CREATE FUNCTION {function}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            {routing_statement(prefix, layout)};
+            RETURN NULL;
+        END
+        $$
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER {function} AFTER INSERT ON {layout.ratingstablename}
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {function}()
+    """)
+
+
+def routing_statement(prefix, layout, ctes=()):
+    """
+    SQL statement writing the transition table new_rows to the @prefix partitions of @layout, with the same
+    partition choice as the client-side insert functions. The partitions after the first are filled by
+    data-modifying CTEs, so a single statement covers all of them. @ctes are put first in the WITH list
+    (one of them may define new_rows itself).
+    """
+    columns = "userid, movieid, rating"
+    if layout.backend == 'declarative':
+        return ((f"WITH {', '.join(ctes)} " if ctes else "") +
+                f"INSERT INTO {partition_parent(layout.ratingstablename, prefix)} ({columns}) "
+                f"SELECT {columns} FROM new_rows")
+    source = "new_rows"
+    numbered = ""
+    if layout.scheme == 'range':
+        bounds = layout.boundaries
+        # Như range_partition_index: rating ngoài [0, 5] vào partition 0
+        predicates = [f"NOT (rating > {bounds[0]} AND rating <= 5.0)" if bounds else "true"]
+        predicates += [range_partition_predicate(i, bounds) for i in range(1, layout.partition_count)]
+    elif layout.scheme == 'roundrobin':
+        # Lấy vị trí từ bộ đếm cho từng dòng đúng một lần, theo thứ tự insert
+        numbered = (f"numbered AS MATERIALIZED (SELECT {columns}, "
+                    f"nextval('{RROBIN_INDEX_SEQUENCE}') % {layout.partition_count} AS slot FROM new_rows)")
+        source = "numbered"
+        predicates = [f"slot = {i}" for i in range(layout.partition_count)]
+    else:
+        expression = hash_partition_expression(layout.partition_key, layout.partition_count)
+        predicates = [f"{expression} = {i}" for i in range(layout.partition_count)]
+    inserts = [f"INSERT INTO {prefix}{i} ({columns}) SELECT {columns} FROM {source} WHERE {predicate}"
+               for i, predicate in enumerate(predicates)]
+    ctes = list(ctes) + ([numbered] if numbered else []) + [f"route{i} AS ({insert})"
+                                                            for i, insert in enumerate(inserts[:-1])]
+    return (f"WITH {', '.join(ctes)} " if ctes else "") + inserts[-1]
+
+
+def forget_routing(cur, ratingstablename):
+    """
+    Marks the partitions of @ratingstablename as client-routed, for when the main table is dropped
+    (which drops its routing triggers with it).
+    """
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (PARTITION_CATALOG,))
+    if cur.fetchone()[0]:
+        cur.execute(f"""
+            ALTER TABLE {PARTITION_CATALOG} ADD COLUMN IF NOT EXISTS routing TEXT NOT NULL DEFAULT 'client';
+            UPDATE {PARTITION_CATALOG} SET routing = 'client' WHERE ratingstablename = %s AND routing <> 'client';
+        """, (ratingstablename,))
+        invalidate_partition_cache()
+
+
+class PartitionRouter(io.TextIOBase):
+    """
+    File-like target for COPY ... TO STDOUT that appends each incoming row to the spool chosen by @route.
+    """
+    def __init__(self, spools, route):
+        self.spools = spools
+        self.route = route
+        self.rows = 0
+
+    def writable(self):
+        return True
+
+    def write(self, line):
+        # psycopg2 gọi write() một lần cho mỗi dòng của COPY
+        self.spools[self.route(line, self.rows)].write(line)
+        self.rows += 1
+        return len(line)
+
+
+class BinaryPartitionRouter(io.RawIOBase):
+    """
+    Binary COPY counterpart of PartitionRouter: drops the stream header and trailer and appends
+    each tuple to the spool chosen by @route.
+    """
+    def __init__(self, spools, route):
+        self.spools = spools
+        self.route = route
+        self.rows = 0
+        self.started = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = len(data)
+        if not self.started:
+            # Header của luồng binary đi chung thông điệp với dòng đầu tiên
+            data = data[len(BINARY_COPY_HEADER):]
+            self.started = True
+        if data and data != BINARY_COPY_TRAILER:
+            self.spools[self.route(data, self.rows)].write(data)
+            self.rows += 1
+        return size
+
+
+def copy_route_partitions(cur, select_sql, prefix, numberofpartitions, route, copy_format='text', freeze=False):
+    """
+    Stream the result of @select_sql out once with COPY and load every row into @prefix<i>,
+    where i = @route(row, rownum). Rows are spooled per partition (in memory, then on disk; the partitions
+    share SPOOL_MAX_SIZE bytes of memory) and copied in after the scan, in the text or binary COPY
+    @copy_format (with FREEZE if @freeze).
+    Returns the number of routed rows.
+    """
+    binary = copy_format == 'binary'
+    options = " WITH (FORMAT binary)" if binary else ""
+    # Bộ nhớ dùng không tăng theo số partition
+    max_size = SPOOL_MAX_SIZE // numberofpartitions
+    spools = [tempfile.SpooledTemporaryFile(max_size=max_size, mode='w+b' if binary else 'w+')
+              for _ in range(numberofpartitions)]
+    try:
+        if binary:
+            for spool in spools:
+                spool.write(BINARY_COPY_HEADER)
+        router = (BinaryPartitionRouter if binary else PartitionRouter)(spools, route)
+        with phase("route") as scan:
+            cur.copy_expert(f"COPY ({select_sql}) TO STDOUT{options}", router)
+            scan.rows = router.rows
+        with phase("copy", router.rows):
+            for i, spool in enumerate(spools):
+                if binary:
+                    spool.write(BINARY_COPY_TRAILER)
+                spool.seek(0)
+                cur.copy_expert(copy_from_sql(f"{prefix}{i}", copy_format, freeze), spool)
+        return router.rows
+    finally:
+        for spool in spools:
+            spool.close()
+
+
+def copy_partition_groups(cur, ratingstablename, prefix, rows, groups):
+    """
+    Writes @rows to the main table and every group of @groups (partition index -> rows) to @prefix<index>,
+    with one binary COPY per table.
+    """
+    if rows:
+        copy_ratings_batch(cur, ratingstablename, rows)
+    for index, group in groups.items():
+        copy_ratings_batch(cur, f"{prefix}{index}", group)
+
+
+def move_rows(cur, source, target, predicate=None, limit=None):
+    """
+    Moves the rows of @source matching the SQL condition @predicate (all rows if None), or any @limit rows,
+    to @target with one DELETE ... RETURNING statement. Returns the number of moved rows.
+    """
+    if limit is not None:
+        where = f"WHERE ctid IN (SELECT ctid FROM {source} LIMIT {int(limit)})"
+    else:
+        where = f"WHERE {predicate}" if predicate is not None else ""
+    cur.execute(f"""
+        WITH moved AS (DELETE FROM {source} {where} RETURNING userid, movieid, rating)
+        INSERT INTO {target} (userid, movieid, rating) SELECT userid, movieid, rating FROM moved
+    """)
+    return cur.rowcount
+
+
+def interval_row_counts(histogram, bounds):
+    """
+    Rows of @histogram ((rating, rows) in rating order) falling in each range partition of @bounds.
+    """
+    counts = [0] * (len(bounds) + 1)
+    for rating, rows in histogram:
+        counts[range_partition_index(rating, bounds)] += rows
+    return counts
+
+
+def split_range_bounds(bounds, histogram, numberofpartitions):
+    """
+    @bounds grown to @numberofpartitions - 1 bounds by repeatedly splitting the interval with the most rows
+    (among those holding at least two distinct ratings) at its median rating. When no interval can be split
+    that way, the widest one is cut in half.
+    """
+    bounds = list(bounds)
+    while len(bounds) + 1 < numberofpartitions:
+        counts = interval_row_counts(histogram, bounds)
+        splittable = [i for i in range(len(counts))
+                      if sum(1 for rating, _ in histogram if range_partition_index(rating, bounds) == i) >= 2]
+        if splittable:
+            i = max(splittable, key=lambda i: counts[i])
+            bound = equi_depth_bounds([(rating, rows) for rating, rows in histogram
+                                       if range_partition_index(rating, bounds) == i], 2)[0]
+        else:
+            edges = [0.0] + bounds + [5.0]
+            i = max(range(len(edges) - 1), key=lambda i: edges[i + 1] - edges[i])
+            bound = (edges[i] + edges[i + 1]) / 2
+        bounds.insert(i, float(bound))
+    return bounds
+
+
+def merge_range_bounds(bounds, histogram, numberofpartitions):
+    """
+    @bounds shrunk to @numberofpartitions - 1 bounds by repeatedly removing the bound between the two adjacent
+    intervals with the fewest rows together.
+    """
+    bounds = list(bounds)
+    while len(bounds) + 1 > numberofpartitions:
+        counts = interval_row_counts(histogram, bounds)
+        del bounds[min(range(len(bounds)), key=lambda i: counts[i] + counts[i + 1])]
+    return bounds
+
+
+def resize_range_bounds(bounds, histogram, numberofpartitions):
+    """
+    @bounds grown (split_range_bounds) or shrunk (merge_range_bounds) to @numberofpartitions - 1 bounds.
+    """
+    if numberofpartitions >= len(bounds) + 1:
+        return split_range_bounds(bounds, histogram, numberofpartitions)
+    return merge_range_bounds(bounds, histogram, numberofpartitions)
+
+
+def range_regroup_plan(bounds, newbounds):
+    """
+    How repartition_range regroups the intervals of @bounds into those of @newbounds, where @newbounds
+    either only adds bounds (growing) or only removes them (shrinking).
+    :return: (first, last, keeper): old interval i covers new intervals first[i]..last[i], and keeper maps
+             every new index that keeps an old table to that old interval
+    """
+    oldcount = len(bounds) + 1
+    numberofpartitions = len(newbounds) + 1
+    # Khoảng cũ i phủ các khoảng mới first[i]..last[i] (một khoảng khi gộp, nhiều khoảng khi tách)
+    first = [bisect_left(newbounds, bounds[i - 1]) + 1 if i > 0 else 0 for i in range(oldcount)]
+    last = [bisect_left(newbounds, bounds[i]) if i < len(bounds) else numberofpartitions - 1
+            for i in range(oldcount)]
+    if numberofpartitions < oldcount:
+        first = last
+    
+    # Khoảng mới đầu tiên của mỗi khoảng cũ giữ bảng cũ;
+    # khi gộp, bảng cũ đầu tiên được giữ
+    keeper = {}
+    for i in range(oldcount):
+        keeper.setdefault(first[i], i)
+    return first, last, keeper
+
+
+def repartition_range(cur, prefix, bounds, numberofpartitions):
+    """
+    Regroups the range partitions @prefix<i> of @bounds into @numberofpartitions partitions (see repartition).
+    Every old interval is either split into new ones (growing) or merged into one (shrinking); the first
+    new interval of a split, or the first old interval of a merge, keeps its table under the new index, so
+    partition 0 still holds the ratings outside [0, 5].
+    :return: (moved rows, new bounds)
+    """
+    oldcount = len(bounds) + 1
+    histogram = []
+    if oldcount != numberofpartitions:
+        cur.execute("SELECT rating, COUNT(*) FROM (" + " UNION ALL ".join(
+            f"SELECT rating FROM {prefix}{i}" for i in range(oldcount))
+            + ") t WHERE rating >= 0 AND rating <= 5.0 GROUP BY rating ORDER BY rating")
+        histogram = cur.fetchall()
+    newbounds = resize_range_bounds(bounds, histogram, numberofpartitions)
+    
+    # Mỗi bảng cũ đổi sang tên tạm để đánh số lại không bị trùng tên
+    staged = [f"{prefix}_repartition_{i}" for i in range(oldcount)]
+    for i in range(oldcount):
+        cur.execute(f"ALTER TABLE {prefix}{i} RENAME TO {staged[i]}")
+    for j in range(oldcount, numberofpartitions):
+        # Bảng thừa của một lần phân vùng trước với nhiều partition hơn
+        cur.execute(f"DROP TABLE IF EXISTS {prefix}{j}")
+    
+    first, last, keeper = range_regroup_plan(bounds, newbounds)
+    
+    moved = 0
+    for j in range(numberofpartitions):
+        if j not in keeper:
+            cur.execute(f"CREATE TABLE {prefix}{j} (userid INTEGER, movieid INTEGER, rating FLOAT)")
+    for i in range(oldcount):
+        if keeper[first[i]] != i:
+            # Gộp: chuyển toàn bộ bảng cũ sang bảng được giữ lại
+            moved += move_rows(cur, staged[i], staged[keeper[first[i]]])
+            cur.execute(f"DROP TABLE {staged[i]}")
+        else:
+            # Tách: các khoảng mới sau khoảng đầu tiên nhận phần dòng của chúng
+            for child in range(first[i] + 1, last[i] + 1):
+                moved += move_rows(cur, staged[i], f"{prefix}{child}",
+                                   range_partition_predicate(child, newbounds))
+    for j, i in keeper.items():
+        cur.execute(f"ALTER TABLE {staged[i]} RENAME TO {prefix}{j}")
+    return moved, newbounds
+
+
+def repartition_roundrobin(cur, prefix, oldcount, numberofpartitions):
+    """
+    Rebalances the round robin partitions @prefix<i> over @numberofpartitions tables (see repartition):
+    partition j ends with total // n rows plus one for j < total mod n, exactly like a fresh round robin build.
+    :return: moved rows
+    """
+    cur.execute(" UNION ALL ".join(f"SELECT {i}, COUNT(*) FROM {prefix}{i}" for i in range(oldcount))
+                + " ORDER BY 1")
+    counts = [count for _, count in cur.fetchall()]
+    total = sum(counts)
+    targets = [total // numberofpartitions + (1 if j < total % numberofpartitions else 0)
+               for j in range(numberofpartitions)]
+    for j in range(oldcount, numberofpartitions):
+        cur.execute(f"""
+            DROP TABLE IF EXISTS {prefix}{j};
+            CREATE TABLE {prefix}{j} (userid INTEGER, movieid INTEGER, rating FLOAT);
+        """)
+    counts += [0] * (numberofpartitions - oldcount)
+    targets += [0] * (oldcount - numberofpartitions)
+    
+    moved = 0
+    receivers = [j for j in range(len(counts)) if counts[j] < targets[j]]
+    for i in range(len(counts)):
+        while counts[i] > targets[i]:
+            j = receivers[0]
+            count = min(counts[i] - targets[i], targets[j] - counts[j])
+            moved += move_rows(cur, f"{prefix}{i}", f"{prefix}{j}", limit=count)
+            counts[i] -= count
+            counts[j] += count
+            if counts[j] == targets[j]:
+                receivers.pop(0)
+    for i in range(numberofpartitions, oldcount):
+        cur.execute(f"DROP TABLE {prefix}{i}")
+    
+    # Dòng tiếp theo tiếp tục vòng round robin sau total dòng
+    reset_rr_index(cur, total % numberofpartitions)
+    return moved
+
+
+def repartition_hash(cur, prefix, oldcount, numberofpartitions, key):
+    """
+    Moves the rows of the hash partitions @prefix<i> whose @key mod @numberofpartitions is not i
+    (see repartition). Each old partition is scanned once: the rows leaving it go through a staging table.
+    :return: moved rows
+    """
+    expression = hash_partition_expression(key, numberofpartitions)
+    staging = f"{prefix}_repartition"
+    cur.execute(f"""
+        CREATE TEMPORARY TABLE {staging} (userid INTEGER, movieid INTEGER, rating FLOAT, target INTEGER)
+        ON COMMIT DROP
+    """)
+    for j in range(oldcount, numberofpartitions):
+        cur.execute(f"""
+            DROP TABLE IF EXISTS {prefix}{j};
+            CREATE TABLE {prefix}{j} (userid INTEGER, movieid INTEGER, rating FLOAT);
+        """)
+    
+    moved = 0
+    for i in range(oldcount):
+        cur.execute(f"""
+            WITH moved AS (DELETE FROM {prefix}{i} WHERE {expression} <> {i} RETURNING userid, movieid, rating)
+            INSERT INTO {staging} (userid, movieid, rating, target)
+            SELECT userid, movieid, rating, {expression} FROM moved
+        """)
+        moved += cur.rowcount
+    for j in range(numberofpartitions):
+        cur.execute(f"""
+            INSERT INTO {prefix}{j} (userid, movieid, rating)
+            SELECT userid, movieid, rating FROM {staging} WHERE target = {j}
+        """)
+    for i in range(numberofpartitions, oldcount):
+        cur.execute(f"DROP TABLE {prefix}{i}")
+    cur.execute(f"DROP TABLE {staging}")
+    return moved
+
+
+def reset_rr_index(cur, index):
+    """
+    Creates the round robin counter if needed and sets it so that the next insert goes to position @index.
+    The sequence is kept rather than recreated, since a declarative round robin parent depends on it.
+    """
+    cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {RROBIN_INDEX_SEQUENCE} MINVALUE 0")
+    cur.execute("SELECT setval(%s, %s, false)", (RROBIN_INDEX_SEQUENCE, int(index)))
+
+
+def seed_rr_index(prefix, numberofpartitions, openconnection):
+    """
+    Creates the round robin counter of partitions built before it existed (their position was kept in a
+    file), continuing the deal from the rows already in @prefix0 .. @prefix<numberofpartitions - 1>.
+    The counter is committed unless the caller has a transaction open. Returns False when it is left in the
+    caller's transaction, True when it is committed (or already existed).
+    """
+    conn = openconnection
+    idle = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NULL", (RROBIN_INDEX_SEQUENCE,))
+        if not cur.fetchone()[0]:
+            return True
+        cur.execute("SELECT " + " + ".join(f"(SELECT COUNT(*) FROM {prefix}{i})" for i in range(numberofpartitions)))
+        reset_rr_index(cur, cur.fetchone()[0] % numberofpartitions)
+    if conn.autocommit:
+        return True
+    if idle:
+        conn.commit()
+    return idle
+
+
+def next_rr_indexes(cur, count):
+    """
+    Takes the next @count round robin positions from the database counter in one round trip.
+    nextval() is not transactional and takes no row lock, so concurrent writers never wait on each other;
+    a rolled-back insert leaves a gap in the sequence instead of a stale position.
+    """
+    if count <= 0:
+        return []
+    cur.execute("SELECT nextval(%s) FROM generate_series(1, %s)", (RROBIN_INDEX_SEQUENCE, count))
+    return [row[0] for row in cur.fetchall()]
+
+
+def insert_statement(ratingstablename, prefix, layout, index=None):
+    """
+    Parameterized ($1 userid, $2 movieid, $3 rating) statement inserting one row into @ratingstablename and
+    into its @prefix partition of @layout: partition @index, or for round robin (@index None) the slot taken
+    from the database counter inside the statement. The main table write is a data-modifying CTE, so both
+    writes are one statement; with trigger routing only the main table is written.
+    """
+    main = f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES ($1, $2, $3)"
+    if layout.routing == 'trigger':
+        return main
+    if layout.backend == 'tables' and index is None:
+        return routing_statement(prefix, layout, [f"new_rows AS ({main} RETURNING userid, movieid, rating)"])
+    if layout.backend == 'declarative':
+        table_name = partition_parent(layout.ratingstablename, prefix)
+    else:
+        table_name = f"{prefix}{index}"
+    return f"WITH main AS ({main}) INSERT INTO {table_name} (userid, movieid, rating) VALUES ($1, $2, $3)"
+
+
+def execute_prepared(openconnection, sql, params):
+    """
+    Executes @sql with the three insert @params through a server-side prepared statement of @openconnection,
+    prepared in the same round trip the first time the connection runs @sql, and commits. When no transaction
+    is open the statement runs in autocommit mode, where it commits by itself: the insert is then a single
+    round trip. The prepared statements of a connection are forgotten on error (see forget_prepared).
+    """
+    conn = openconnection
+    statements = PREPARED_STATEMENTS.setdefault(conn, {})
+    name = statements.get(sql)
+    prepare = ""
+    if name is None:
+        if len(statements) >= PREPARED_STATEMENT_LIMIT:
+            prepare = "DEALLOCATE ALL; "
+            statements.clear()
+        name = f"ratings_insert_{uuid.uuid4().hex}"
+        prepare += f"PREPARE {name} (integer, integer, float) AS {sql}; "
+        statements[sql] = name
+    
+    # Bật autocommit chỉ đổi cờ phía client, không tốn thêm round trip
+    single = not conn.autocommit and conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    if single:
+        conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            # Toán tử % trong câu lệnh không phải tham số của psycopg2
+            cur.execute(prepare.replace('%', '%%') + f"EXECUTE {name} (%s, %s, %s)", params)
+    finally:
+        if single:
+            conn.autocommit = False
+    if not single and not conn.autocommit:
+        conn.commit()
+
+
+def forget_prepared(openconnection):
+    """
+    Drops the prepared statement cache of @openconnection after an error. PREPARE is not undone by a rollback,
+    so the statements may or may not exist on the server; new ones are prepared under fresh names and the old
+    ones live until the session ends (or the next DEALLOCATE ALL).
+    """
+    PREPARED_STATEMENTS.pop(openconnection, None)
+
+
+def worker_connection_params(openconnection):
+    """
+    getopenconnection arguments that reach the same database, as the same user and with the same password,
+    as @openconnection.
+    """
+    params = openconnection.get_dsn_parameters()
+    # Mật khẩu không có trong get_dsn_parameters(); '' khi kết nối không dùng mật khẩu
+    return {'user': params['user'], 'password': openconnection.info.password or '', 'dbname': params['dbname']}
+
+
+def worker_pool(openconnection, size):
+    """
+    Shared pool of connections to the same database, as the same user, as @openconnection,
+    with room for @size concurrent workers besides the connections already checked out of it.
+    """
+    pool = get_pool(size, **worker_connection_params(openconnection))
+    pool.reserve(size)
+    return pool
+
+
+def parallel_execute(openconnection, statements, workers, shared_snapshot=False):
+    """
+    Executes @statements concurrently, spread over up to @workers connections taken from the worker pool.
+    The build is all-or-nothing: every worker keeps its transaction open until all statements succeeded,
+    then all workers commit (through two-phase commit when the server allows prepared transactions,
+    so the commit itself is atomic) or all of them roll back. Returns the number of rows the statements wrote.
+    With @shared_snapshot the workers run REPEATABLE READ transactions on one snapshot, exported by an extra
+    pooled connection, so they all read the same rows even while other sessions write to the tables.
+    Raises psycopg2.pool.PoolError if a worker waits more than POOL_CHECKOUT_TIMEOUT seconds for a connection.
+    """
+    workers = max(1, min(workers, len(statements)))
+    cur = openconnection.cursor()
+    cur.execute("SHOW max_prepared_transactions")
+    two_phase = int(cur.fetchone()[0]) > 0
+    cur.close()
+    gtrid = f"partition-build-{uuid.uuid4().hex}"
+    pool = worker_pool(openconnection, workers + shared_snapshot)
+    with ExitStack() as stack:
+        # Mọi worker giữ kết nối tới khi commit:
+        # chờ có giới hạn để không treo khi pool bị dùng hết
+        connections = [stack.enter_context(pool.connection(POOL_CHECKOUT_TIMEOUT)) for _ in range(workers)]
+        if two_phase:
+            for worker, wconn in enumerate(connections):
+                wconn.tpc_begin(wconn.xid(0, gtrid, str(worker)))
+
+        def share_snapshot():
+            # Transaction xuất snapshot không thể PREPARE nên dùng một kết nối riêng, giữ mở tới khi
+            # mọi worker đã nhập snapshot; pool rollback nó khi trả kết nối
+            with pool.connection(POOL_CHECKOUT_TIMEOUT) as sconn, sconn.cursor() as scur:
+                scur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                scur.execute("SELECT pg_export_snapshot()")
+                snapshot = scur.fetchone()[0]
+                for wconn in connections:
+                    with wconn.cursor() as wcur:
+                        wcur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                        wcur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+
+        def run(worker):
+            wconn = connections[worker]
+            rows = 0
+            with wconn.cursor() as wcur:
+                for statement in statements[worker::workers]:
+                    wcur.execute(statement)
+                    rows += max(wcur.rowcount, 0)
+            if two_phase:
+                wconn.tpc_prepare()
+            return rows
 
+        try:
+            if shared_snapshot:
+                share_snapshot()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                rows = sum(executor.map(run, range(workers)))
+        except Exception:
+            for wconn in connections:
+                if two_phase:
+                    wconn.tpc_rollback()
+                else:
+                    wconn.rollback()
+            raise
 
-def save_rr_index(index):
-    """Save the current index for round robin insert"""
-    start_time = time.time()
-    with open("rr_index.txt", 'w') as f:
-        f.write(str(index))
-    log_execution_time("save_rr_index", start_time)
\ No newline at end of file
+        with phase("parallel_execute.commit"):
+            for wconn in connections:
+                if two_phase:
+                    wconn.tpc_commit()
+                else:
+                    wconn.commit()
+    return rows
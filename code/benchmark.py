@@ -0,0 +1,764 @@
+#
+# Benchmark for the partitioning functions of the assignment
+#
+# Usage: python benchmark.py [ratings file] [number of partitions ...]
+#        python benchmark.py [--rows 1M 10M 25M] [--partitions 5 10 20] [--output results.json]
+#                            [--baseline baseline.json] [--tolerance 0.2] [--metrics metrics.json]
+#
+# Without options the full report is printed for the ratings file. --rows runs on synthetic ratings of
+# MovieLens scale instead; with --rows, --output or --baseline only the core functions are timed, and
+# the results are recorded as JSON and compared against an earlier run. Exits with status 1 when a
+# measurement is worse than the baseline by more than the tolerance.
+#
+DATABASE_NAME = 'dds_assgn1'
+
+RATINGS_TABLE = 'ratings'
+INPUT_FILE_PATH = 'test_data.dat'
+PARTITION_COUNTS = [5, 10, 20]
+PARTITION_METHODS = ('loop', 'parallel', 'single_pass')
+REPARTITION_COUNTS = (8, 10)  # Partition counts before and after repartition
+INSERT_ROWS = 2000  # Rows inserted by each insert measurement
+LATENCY_WARMUP = 200  # Inserts before the latency measurement starts
+REPEAT = 3  # Each measurement keeps the best of REPEAT runs
+DEFAULT_TOLERANCE = 0.2  # Allowed slowdown against the baseline (0.2 = 20%)
+
+# Synthetic ratings
+RATINGS_PER_USER = 150  # MovieLens 25M: 25M ratings, 162k users
+RATINGS_PER_MOVIE = 400  # MovieLens 25M: 25M ratings, 62k movies
+USER_SKEW = 0.5  # Zipf exponents of user activity and movie popularity; the heaviest user and movie
+MOVIE_SKEW = 0.8  # then hold about 0.6% and 5% of 1M generated ratings
+GENERATOR_CHUNK = 1_000_000  # Rows generated and written at a time
+FIRST_TIMESTAMP = 789652009  # Timestamp range of MovieLens 25M
+LAST_TIMESTAMP = 1574327703
+
+# Share of each rating value in MovieLens 25M
+RATING_WEIGHTS = {
+    0.5: 0.016, 1.0: 0.031, 1.5: 0.016, 2.0: 0.066, 2.5: 0.050,
+    3.0: 0.196, 3.5: 0.127, 4.0: 0.266, 4.5: 0.087, 5.0: 0.145,
+}
+
+import argparse
+import bz2
+import gzip
+import itertools
+import json
+import lzma
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import psycopg2
+import testHelper
+import Interface as MyAssignment
+
+
+def besttime(function, *args, **kwargs):
+    """
+    Runs @function REPEAT times and returns the fastest wall-clock time in seconds.
+    """
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchpartition(partitionfunction, ratingstablename, numberofpartitions, openconnection,
+                   methods=PARTITION_METHODS):
+    """
+    Times @partitionfunction with the per-partition loop against the parallel and single-pass builds.
+    :return: dict method -> seconds
+    """
+    return {
+        method: besttime(partitionfunction, ratingstablename, numberofpartitions, openconnection, method=method)
+        for method in methods
+    }
+
+
+def benchloadratings(ratingstablename, ratingsfilepath, openconnection, workers):
+    """
+    Times loadratings in one process against the multi-process loader with @workers processes.
+    :return: dict mode -> seconds
+    """
+    return {
+        'serial': besttime(MyAssignment.loadratings, ratingstablename, ratingsfilepath, openconnection),
+        'workers={0}'.format(workers): besttime(MyAssignment.loadratings, ratingstablename, ratingsfilepath,
+                                                openconnection, workers=workers),
+    }
+
+
+class NullCopyCursor:
+    """
+    Cursor stand-in that reads and discards COPY data, so the parsers can be timed without a server.
+    It counts the bytes that would have been sent.
+    """
+    def __init__(self):
+        self.bytes = 0
+
+    def copy_expert(self, sql, file):
+        self.bytes += len(file.read())
+
+
+def benchparser(ratingsfilepath):
+    """
+    Microbenchmark of the client-side work of loadratings: the line loop building text COPY buffers
+    against the mmap/NumPy parser building binary COPY buffers. No database is involved.
+    :return: dict parser -> seconds
+    """
+    def lines():
+        with open(ratingsfilepath, 'r') as f:
+            MyAssignment.copy_ratings_lines(NullCopyCursor(), RATINGS_TABLE, f)
+
+    def vectorized():
+        MyAssignment.copy_ratings_arrays(NullCopyCursor(), RATINGS_TABLE,
+                                         MyAssignment.parse_ratings_mmap(ratingsfilepath))
+
+    results = {'lines': besttime(lines)}
+    if MyAssignment.np is not None:
+        results['mmap'] = besttime(vectorized)
+    return results
+
+
+def benchcopyformat(ratingstablename, ratingsfilepath, openconnection, numberofpartitions):
+    """
+    Times loadratings and the single-pass round robin build with text COPY against binary COPY.
+    :return: dict (title, format) -> seconds
+    """
+    results = {}
+    for copy_format in ('text', 'binary'):
+        results[('loadratings', copy_format)] = besttime(MyAssignment.loadratings, ratingstablename,
+                                                         ratingsfilepath, openconnection, copy_format=copy_format)
+    for copy_format in ('text', 'binary'):
+        results[('roundrobinpartition', copy_format)] = besttime(
+            MyAssignment.roundrobinpartition, ratingstablename, numberofpartitions, openconnection,
+            method='single_pass', copy_format=copy_format)
+    return results
+
+
+def benchcompressed(ratingstablename, ratingsfilepath, openconnection):
+    """
+    Times loadratings on the plain file and on gzip, bzip2 and xz copies of it (written to a temporary
+    directory), each with the serial loader and with the pipelined one.
+    :return: dict (input, loader) -> seconds
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        inputs = {'plain': ratingsfilepath}
+        for extension, opener in (('.gz', gzip.open), ('.bz2', bz2.open), ('.xz', lzma.open)):
+            inputs[extension] = os.path.join(directory, os.path.basename(ratingsfilepath) + extension)
+            with open(ratingsfilepath, 'rb') as source, opener(inputs[extension], 'wb') as target:
+                shutil.copyfileobj(source, target)
+        for name, path in inputs.items():
+            for loader, pipeline in (('serial', False), ('pipeline', True)):
+                results[(name, loader)] = besttime(MyAssignment.loadratings, ratingstablename, path,
+                                                   openconnection, pipeline=pipeline)
+    return results
+
+
+def copybytes(ratingsfilepath):
+    """
+    Number of bytes loadratings sends to the server with text and with binary COPY.
+    :return: dict format -> bytes
+    """
+    results = {}
+    for copy_format in ('text', 'binary'):
+        cursor = NullCopyCursor()
+        with open(ratingsfilepath, 'r') as f:
+            MyAssignment.copy_ratings_lines(cursor, RATINGS_TABLE, f, copy_format=copy_format)
+        results[copy_format] = cursor.bytes
+    return results
+
+
+def benchinserts(ratingstablename, numberofpartitions, openconnection):
+    """
+    Rows per second of the single-row insert functions called in a loop against their batch versions
+    and against the same per-row calls going through a BufferedWriter (closed inside the measurement).
+    Partitions are rebuilt before each measurement.
+    :return: dict (title, api) -> rows/sec
+    """
+    rows = [(random.randint(1, 100000), random.randint(1, 50000), random.choice([0.5, 1, 2, 3, 3.5, 4, 4.5, 5]))
+            for _ in range(INSERT_ROWS)]
+
+    def loop(insertfunction):
+        for userid, movieid, rating in rows:
+            insertfunction(ratingstablename, userid, movieid, rating, openconnection)
+
+    def buffered(scheme):
+        with MyAssignment.BufferedWriter(ratingstablename, openconnection, scheme=scheme) as writer:
+            for userid, movieid, rating in rows:
+                writer.insert(userid, movieid, rating)
+
+    results = {}
+    for title, scheme, partitionfunction, single, many in (
+            ('rangeinsert', 'range', MyAssignment.rangepartition, MyAssignment.rangeinsert,
+             MyAssignment.rangeinsert_many),
+            ('roundrobininsert', 'roundrobin', MyAssignment.roundrobinpartition, MyAssignment.roundrobininsert,
+             MyAssignment.roundrobininsert_many)):
+        partitionfunction(ratingstablename, numberofpartitions, openconnection)
+        results[(title, 'single')] = INSERT_ROWS / besttime(loop, single)
+        results[(title, 'many')] = INSERT_ROWS / besttime(many, ratingstablename, rows, openconnection)
+        results[(title, 'buffered')] = INSERT_ROWS / besttime(buffered, scheme)
+    return results
+
+
+def benchlatency(ratingstablename, numberofpartitions, openconnection):
+    """
+    Per-call latency of the single-row insert functions: median and 99th percentile of INSERT_ROWS calls,
+    after a short warm-up (the first call on each partition prepares its statement).
+    :return: dict (title, percentile) -> seconds
+    """
+    rows = [(random.randint(1, 100000), random.randint(1, 50000), random.choice([0.5, 1, 2, 3, 3.5, 4, 4.5, 5]))
+            for _ in range(INSERT_ROWS)]
+    results = {}
+    for title, partitionfunction, insertfunction in (
+            ('rangeinsert', MyAssignment.rangepartition, MyAssignment.rangeinsert),
+            ('roundrobininsert', MyAssignment.roundrobinpartition, MyAssignment.roundrobininsert),
+            ('hashinsert', MyAssignment.hashpartition, MyAssignment.hashinsert)):
+        partitionfunction(ratingstablename, numberofpartitions, openconnection)
+        for userid, movieid, rating in rows[:LATENCY_WARMUP]:
+            insertfunction(ratingstablename, userid, movieid, rating, openconnection)
+        latencies = []
+        for userid, movieid, rating in rows:
+            start = time.perf_counter()
+            insertfunction(ratingstablename, userid, movieid, rating, openconnection)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        results[(title, 'p50')] = latencies[len(latencies) // 2]
+        results[(title, 'p99')] = latencies[int(len(latencies) * 0.99)]
+    return results
+
+
+def benchrouting(ratingstablename, numberofpartitions, openconnection):
+    """
+    Rows per second of the single-row and batch insert functions with client-side routing (main table and
+    partition written by the client) against trigger routing (only the main table is written, a statement
+    trigger fills the partition). Partitions are rebuilt with each routing mode before its measurements.
+    :return: dict (title, 'api routing') -> rows/sec
+    """
+    rows = [(random.randint(1, 100000), random.randint(1, 50000), random.choice([0.5, 1, 2, 3, 3.5, 4, 4.5, 5]))
+            for _ in range(INSERT_ROWS)]
+
+    def loop(insertfunction):
+        for userid, movieid, rating in rows:
+            insertfunction(ratingstablename, userid, movieid, rating, openconnection)
+
+    results = {}
+    for title, partitionfunction, single, many in (
+            ('rangeinsert', MyAssignment.rangepartition, MyAssignment.rangeinsert, MyAssignment.rangeinsert_many),
+            ('roundrobininsert', MyAssignment.roundrobinpartition, MyAssignment.roundrobininsert,
+             MyAssignment.roundrobininsert_many)):
+        for routing in MyAssignment.ROUTING_MODES:
+            partitionfunction(ratingstablename, numberofpartitions, openconnection, routing=routing)
+            results[(title, 'single ' + routing)] = INSERT_ROWS / besttime(loop, single)
+            results[(title, 'many ' + routing)] = INSERT_ROWS / besttime(many, ratingstablename, rows, openconnection)
+        # Later benchmarks expect client routing
+        partitionfunction(ratingstablename, numberofpartitions, openconnection)
+    return results
+
+
+def benchqueries(ratingstablename, numberofpartitions, openconnection):
+    """
+    Times a narrow rating query (one rating value) and a whole-range query against the range partitions,
+    which are pruned, and against the round robin partitions, which are all read.
+    :return: dict (title, scheme) -> seconds
+    """
+    MyAssignment.rangepartition(ratingstablename, numberofpartitions, openconnection)
+    MyAssignment.roundrobinpartition(ratingstablename, numberofpartitions, openconnection)
+
+    def drain(rows):
+        for _ in rows:
+            pass
+
+    results = {}
+    for title, lo, hi in (('pointquery', 3.5, 3.5), ('rangequery', 0.0, 5.0)):
+        for scheme in ('roundrobin', 'range'):
+            results[(title, scheme)] = besttime(
+                lambda: drain(MyAssignment.rangequery(lo, hi, openconnection, scheme=scheme)))
+    return results
+
+
+def benchaggregates(ratingstablename, numberofpartitions, openconnection):
+    """
+    Times whole-dataset aggregates computed by one query on @ratingstablename against the scatter-gather
+    versions over the round robin partitions.
+    :return: dict (title, mode) -> seconds
+    """
+    MyAssignment.roundrobinpartition(ratingstablename, numberofpartitions, openconnection)
+    cur = openconnection.cursor()
+
+    def single(query):
+        cur.execute(query.format(ratingstablename))
+        cur.fetchall()
+
+    results = {
+        ('count', 'single'): besttime(single, "SELECT COUNT(*) FROM {0}"),
+        ('count', 'scatter'): besttime(MyAssignment.count_ratings, openconnection,
+                                       workers=numberofpartitions),
+        ('movie average', 'single'): besttime(single, "SELECT movieid, AVG(rating) FROM {0} GROUP BY movieid"),
+        ('movie average', 'scatter'): besttime(MyAssignment.movie_average_ratings, openconnection,
+                                               workers=numberofpartitions),
+    }
+    cur.close()
+    return results
+
+
+def benchbackends(ratingstablename, numberofpartitions, openconnection):
+    """
+    Times the table-per-partition backend (single-pass builds) against declarative partitioning:
+    building both schemes, batch inserts and a one-rating query on the range partitions.
+    The main table gets the inserted rows too, so it is reloaded afterwards by the caller.
+    :return: dict (title, backend) -> seconds
+    """
+    rows = [(random.randint(1, 100000), random.randint(1, 50000), random.choice([0.5, 1, 2, 3, 3.5, 4, 4.5, 5]))
+            for _ in range(INSERT_ROWS)]
+
+    def drain(rows):
+        for _ in rows:
+            pass
+
+    results = {}
+    for backend in MyAssignment.PARTITION_BACKENDS:
+        method = 'single_pass' if backend == 'tables' else 'loop'
+        for title, partitionfunction, many in (
+                ('range', MyAssignment.rangepartition, MyAssignment.rangeinsert_many),
+                ('roundrobin', MyAssignment.roundrobinpartition, MyAssignment.roundrobininsert_many)):
+            results[(title + ' build', backend)] = besttime(partitionfunction, ratingstablename, numberofpartitions,
+                                                            openconnection, method=method, backend=backend)
+            results[(title + ' insert', backend)] = besttime(many, ratingstablename, rows, openconnection)
+        results[('pointquery', backend)] = besttime(
+            lambda: drain(MyAssignment.pointquery(3.5, openconnection)))
+    return results
+
+
+def benchlookups(ratingstablename, numberofpartitions, openconnection):
+    """
+    Times the ratings-of-one-user lookup on the main table against hashquery on userid hash partitions.
+    :return: dict mode -> seconds
+    """
+    MyAssignment.hashpartition(ratingstablename, numberofpartitions, openconnection, key='userid')
+    cur = openconnection.cursor()
+    cur.execute("SELECT userid FROM {0} LIMIT 1".format(ratingstablename))
+    userid = cur.fetchone()[0]
+
+    def scan():
+        cur.execute("SELECT userid, movieid, rating FROM {0} WHERE userid = %s".format(ratingstablename), (userid,))
+        cur.fetchall()
+
+    results = {
+        'main table': besttime(scan),
+        'hashquery': besttime(lambda: list(MyAssignment.hashquery(userid, openconnection))),
+    }
+    cur.close()
+    return results
+
+
+def benchindexes(ratingstablename, ratingsfilepath, numberofpartitions, openconnection):
+    """
+    Times a userid lookup on the main table and a movieid lookup across the round robin partitions,
+    before and after the index stage, and the index stage itself.
+    :return: dict (title, mode) -> seconds
+    """
+    MyAssignment.loadratings(ratingstablename, ratingsfilepath, openconnection)
+    MyAssignment.roundrobinpartition(ratingstablename, numberofpartitions, openconnection)
+    tables = ['{0}{1}'.format(MyAssignment.PARTITION_PREFIXES['roundrobin'], i) for i in range(numberofpartitions)]
+    cur = openconnection.cursor()
+    cur.execute("SELECT userid, movieid FROM {0} LIMIT 1".format(ratingstablename))
+    userid, movieid = cur.fetchone()
+
+    def userlookup():
+        cur.execute("SELECT userid, movieid, rating FROM {0} WHERE userid = %s".format(ratingstablename), (userid,))
+        cur.fetchall()
+
+    def movielookup():
+        for table in tables:
+            cur.execute("SELECT userid, movieid, rating FROM {0} WHERE movieid = %s".format(table), (movieid,))
+            cur.fetchall()
+
+    results = {('user lookup', 'no index'): besttime(userlookup), ('movie lookup', 'no index'): besttime(movielookup)}
+    start = time.perf_counter()
+    MyAssignment.buildindexes([ratingstablename] + tables, openconnection)
+    results[('index build', 'indexed')] = time.perf_counter() - start
+    results[('user lookup', 'indexed')] = besttime(userlookup)
+    results[('movie lookup', 'indexed')] = besttime(movielookup)
+    cur.close()
+    return results
+
+
+def benchboundaries(ratingstablename, numberofpartitions, openconnection):
+    """
+    Rows per range partition with equal-width and with equi-depth boundaries.
+    :return: dict boundaries -> list of row counts
+    """
+    results = {}
+    for boundaries in ('equal_width', 'equi_depth'):
+        MyAssignment.rangepartition(ratingstablename, numberofpartitions, openconnection, boundaries=boundaries)
+        results[boundaries] = [rows for _, rows in MyAssignment.partition_row_counts('range', openconnection)]
+    return results
+
+
+def benchrepartition(ratingstablename, oldcount, newcount, openconnection):
+    """
+    Times going from @oldcount to @newcount partitions with a full rebuild against repartition,
+    for each scheme. The partitions are rebuilt with @oldcount before every measurement.
+    :return: dict (scheme, mode) -> seconds, dict scheme -> rows moved by repartition
+    """
+    results = {}
+    moved = {}
+    for scheme, partitionfunction in (('range', MyAssignment.rangepartition),
+                                      ('roundrobin', MyAssignment.roundrobinpartition),
+                                      ('hash', MyAssignment.hashpartition)):
+        results[(scheme, 'rebuild')] = besttime(partitionfunction, ratingstablename, newcount, openconnection)
+        best = None
+        for _ in range(REPEAT):
+            partitionfunction(ratingstablename, oldcount, openconnection)
+            start = time.perf_counter()
+            moved[scheme] = MyAssignment.repartition(scheme, newcount, openconnection)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[(scheme, 'repartition')] = best
+    return results, moved
+
+
+def walbytes(openconnection, function, *args, **kwargs):
+    """
+    Runs @function once and returns (seconds, bytes of WAL written meanwhile by the whole server).
+    """
+    cur = openconnection.cursor()
+    cur.execute("SELECT pg_current_wal_lsn()")
+    before = cur.fetchone()[0]
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    cur.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)", (before,))
+    size = int(cur.fetchone()[0])
+    cur.close()
+    return elapsed, size
+
+
+def vacuumfreeze(ratingstablename):
+    """
+    VACUUM FREEZE of @ratingstablename on a connection of its own, since VACUUM cannot run in a transaction.
+    """
+    conn = testHelper.getopenconnection(dbname=DATABASE_NAME)
+    try:
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute("VACUUM FREEZE {0}".format(ratingstablename))
+    finally:
+        conn.close()
+
+
+def benchbulk(ratingstablename, ratingsfilepath, numberofpartitions, openconnection):
+    """
+    Load time and WAL volume of loadratings and of the single-pass round robin build in each bulk mode,
+    plus the time of the VACUUM FREEZE that the loaded table needs afterwards.
+    :return: dict (title, bulk mode) -> (seconds, WAL bytes)
+    """
+    results = {}
+    for bulk in MyAssignment.BULK_MODES:
+        mode = bulk or 'default'
+        results[('loadratings', mode)] = walbytes(openconnection, MyAssignment.loadratings, ratingstablename,
+                                                  ratingsfilepath, openconnection, bulk=bulk)
+        results[('vacuum freeze', mode)] = walbytes(openconnection, vacuumfreeze, ratingstablename)
+        results[('roundrobinpartition', mode)] = walbytes(
+            openconnection, MyAssignment.roundrobinpartition, ratingstablename, numberofpartitions, openconnection,
+            method='single_pass', bulk=bulk)
+    return results
+
+
+def printresults(title, n, results):
+    """
+    Prints one line per variant with its speedup against the first (baseline) variant.
+    """
+    baseline = next(iter(results.values()))
+    for method, seconds in results.items():
+        print('{0:<32} n={1:<4} {2:<12} {3:9.4f}s  x{4:.2f}'.format(
+            title, n, method, seconds, baseline / seconds if seconds else 0.0))
+
+
+def report(inputfile, partitioncounts, openconnection):
+    """
+    Prints every benchmark above for the ratings in @inputfile and each of @partitioncounts.
+    """
+    conn = openconnection
+    printresults('parser', 1, benchparser(inputfile))
+    workers = os.cpu_count() or 1
+    printresults('loadratings', workers, benchloadratings(RATINGS_TABLE, inputfile, conn, workers))
+
+    formats = benchcopyformat(RATINGS_TABLE, inputfile, conn, partitioncounts[0])
+    for title in ('loadratings', 'roundrobinpartition'):
+        printresults('copy format ' + title, partitioncounts[0],
+                     {f: seconds for (t, f), seconds in formats.items() if t == title})
+    for copy_format, size in copybytes(inputfile).items():
+        print('{0:<32} {1:<12} {2} bytes'.format('copy bytes', copy_format, size))
+    compressed = benchcompressed(RATINGS_TABLE, inputfile, conn)
+    for name in ('plain', '.gz', '.bz2', '.xz'):
+        printresults('loadratings ' + name, 1, {l: seconds for (n, l), seconds in compressed.items() if n == name})
+
+    for (title, mode), (seconds, size) in benchbulk(RATINGS_TABLE, inputfile, partitioncounts[0], conn).items():
+        print('{0:<32} n={1:<4} {2:<12} {3:9.4f}s  {4} WAL bytes'.format(
+            'bulk ' + title, partitioncounts[0], mode, seconds, size))
+
+    for n in partitioncounts:
+        printresults('rangepartition', n, benchpartition(MyAssignment.rangepartition, RATINGS_TABLE, n, conn))
+        printresults('roundrobinpartition', n,
+                     benchpartition(MyAssignment.roundrobinpartition, RATINGS_TABLE, n, conn))
+        for (title, api), rate in benchinserts(RATINGS_TABLE, n, conn).items():
+            print('{0:<32} n={1:<4} {2:<12} {3:9.0f} rows/s'.format(title, n, api, rate))
+        for (title, percentile), seconds in benchlatency(RATINGS_TABLE, n, conn).items():
+            print('{0:<32} n={1:<4} {2:<12} {3:9.1f} us'.format('latency ' + title, n, percentile, seconds * 1e6))
+        for (title, api), rate in benchrouting(RATINGS_TABLE, n, conn).items():
+            print('{0:<32} n={1:<4} {2:<16} {3:9.0f} rows/s'.format('routing ' + title, n, api, rate))
+        queries = benchqueries(RATINGS_TABLE, n, conn)
+        for title in ('pointquery', 'rangequery'):
+            printresults(title, n, {s: seconds for (t, s), seconds in queries.items() if t == title})
+        aggregates = benchaggregates(RATINGS_TABLE, n, conn)
+        for title in ('count', 'movie average'):
+            printresults(title, n, {m: seconds for (t, m), seconds in aggregates.items() if t == title})
+        for boundaries, counts in benchboundaries(RATINGS_TABLE, n, conn).items():
+            print('{0:<32} n={1:<4} {2:<12} largest/mean {3:.2f}  {4}'.format(
+                'range partition rows', n, boundaries, max(counts) * len(counts) / (sum(counts) or 1), counts))
+        printresults('user lookup', n, benchlookups(RATINGS_TABLE, n, conn))
+        backends = benchbackends(RATINGS_TABLE, n, conn)
+        for title in ('range build', 'range insert', 'roundrobin build', 'roundrobin insert', 'pointquery'):
+            printresults('backend ' + title, n, {b: seconds for (t, b), seconds in backends.items() if t == title})
+        indexes = benchindexes(RATINGS_TABLE, inputfile, n, conn)
+        for title in ('user lookup', 'movie lookup'):
+            printresults(title, n, {m: seconds for (t, m), seconds in indexes.items() if t == title})
+        print('{0:<32} n={1:<4} {2:<12} {3:9.4f}s'.format('index build', n, 'indexed',
+                                                         indexes[('index build', 'indexed')]))
+        MyAssignment.loadratings(RATINGS_TABLE, inputfile, conn)
+
+    oldcount, newcount = REPARTITION_COUNTS
+    timings, moved = benchrepartition(RATINGS_TABLE, oldcount, newcount, conn)
+    for scheme, rows in moved.items():
+        printresults('{0} {1}->{2}'.format(scheme, oldcount, newcount), newcount,
+                     {m: seconds for (s, m), seconds in timings.items() if s == scheme})
+        print('{0:<32} n={1:<4} {2:<12} {3} rows moved'.format(scheme, newcount, 'repartition', rows))
+
+
+def parsecount(text):
+    """
+    Row count written as an integer or with a k/M suffix ('500k', '25M').
+    """
+    text = text.strip()
+    multiplier = {'k': 1_000, 'm': 1_000_000}.get(text[-1:].lower(), 1)
+    return int(float(text[:-1] if multiplier > 1 else text) * multiplier)
+
+
+def zipfweights(count, skew):
+    """
+    Weights of ranks 1..@count under a Zipf law with exponent @skew (0 = uniform).
+    """
+    return [1.0 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def formatrating(rating):
+    return str(int(rating)) if rating == int(rating) else str(rating)
+
+
+def generateratings(ratingsfilepath, rows, users=None, movies=None, user_skew=USER_SKEW, movie_skew=MOVIE_SKEW,
+                    seed=0):
+    """
+    Writes @rows ratings in the MovieLens 'userid::movieid::rating::timestamp' format to @ratingsfilepath.
+    Users and movies are drawn with Zipf-distributed activity and popularity (exponents @user_skew and
+    @movie_skew) over @users and @movies ids, shuffled so the heavy ids are not simply the small ones;
+    ratings follow the MovieLens 25M distribution. The output only depends on the arguments.
+    """
+    users = users or max(1, rows // RATINGS_PER_USER)
+    movies = movies or max(1, rows // RATINGS_PER_MOVIE)
+    ratings = list(RATING_WEIGHTS)
+    labels = [formatrating(rating) for rating in ratings]
+    if MyAssignment.np is not None:
+        np = MyAssignment.np
+        rng = np.random.default_rng(seed)
+        userids = rng.permutation(users) + 1
+        movieids = rng.permutation(movies) + 1
+        userweights = np.array(zipfweights(users, user_skew))
+        movieweights = np.array(zipfweights(movies, movie_skew))
+        ratingweights = np.array(list(RATING_WEIGHTS.values()))
+        labels = np.array(labels)
+        with open(ratingsfilepath, 'w') as f:
+            for start in range(0, rows, GENERATOR_CHUNK):
+                size = min(GENERATOR_CHUNK, rows - start)
+                user = userids[rng.choice(users, size, p=userweights / userweights.sum())]
+                movie = movieids[rng.choice(movies, size, p=movieweights / movieweights.sum())]
+                rating = labels[rng.choice(len(ratings), size, p=ratingweights / ratingweights.sum())]
+                stamp = rng.integers(FIRST_TIMESTAMP, LAST_TIMESTAMP, size)
+                f.write('\n'.join(map('::'.join, zip(user.astype(str), movie.astype(str), rating,
+                                                    stamp.astype(str)))))
+                f.write('\n')
+    else:
+        rng = random.Random(seed)
+        userids = list(range(1, users + 1))
+        movieids = list(range(1, movies + 1))
+        rng.shuffle(userids)
+        rng.shuffle(movieids)
+        usercum = list(itertools.accumulate(zipfweights(users, user_skew)))
+        moviecum = list(itertools.accumulate(zipfweights(movies, movie_skew)))
+        ratingcum = list(itertools.accumulate(RATING_WEIGHTS.values()))
+        with open(ratingsfilepath, 'w') as f:
+            for start in range(0, rows, GENERATOR_CHUNK):
+                size = min(GENERATOR_CHUNK, rows - start)
+                user = rng.choices(userids, cum_weights=usercum, k=size)
+                movie = rng.choices(movieids, cum_weights=moviecum, k=size)
+                rating = rng.choices(labels, cum_weights=ratingcum, k=size)
+                f.writelines('{0}::{1}::{2}::{3}\n'.format(u, m, r, rng.randrange(FIRST_TIMESTAMP, LAST_TIMESTAMP))
+                             for u, m, r in zip(user, movie, rating))
+
+
+def datasetpath(datadir, rows, user_skew, movie_skew, seed):
+    """
+    Generates the dataset for (@rows, @user_skew, @movie_skew, @seed) in @datadir unless it is already there.
+    """
+    path = os.path.join(datadir, 'ratings_{0}_skew{1}-{2}_seed{3}.dat'.format(rows, user_skew, movie_skew, seed))
+    if not os.path.exists(path):
+        start = time.perf_counter()
+        partial = path + '.part'
+        generateratings(partial, rows, user_skew=user_skew, movie_skew=movie_skew, seed=seed)
+        os.replace(partial, path)
+        print('generated {0} rows in {1:.1f}s: {2}'.format(rows, time.perf_counter() - start, path))
+    return path
+
+
+def runsuite(ratingsfilepath, rows, partitioncounts, methods, openconnection):
+    """
+    Times loadratings, rangepartition and roundrobinpartition (each @methods) and measures the insert
+    functions for every partition count of @partitioncounts on the ratings in @ratingsfilepath.
+    :return: list of result records {name, rows, partitions, method, unit, value}
+    """
+    results = []
+
+    def record(name, partitions, method, unit, value):
+        results.append({'name': name, 'rows': rows, 'partitions': partitions, 'method': method,
+                        'unit': unit, 'value': value})
+
+    record('loadratings', None, 'serial', 's',
+           besttime(MyAssignment.loadratings, RATINGS_TABLE, ratingsfilepath, openconnection))
+    for n in partitioncounts:
+        for title, partitionfunction in (('rangepartition', MyAssignment.rangepartition),
+                                         ('roundrobinpartition', MyAssignment.roundrobinpartition)):
+            for method, seconds in benchpartition(partitionfunction, RATINGS_TABLE, n, openconnection,
+                                                  methods).items():
+                record(title, n, method, 's', seconds)
+        for (title, api), rate in benchinserts(RATINGS_TABLE, n, openconnection).items():
+            record(title, n, api, 'rows/s', rate)
+        # The inserts added rows to the main table
+        MyAssignment.loadratings(RATINGS_TABLE, ratingsfilepath, openconnection)
+    return results
+
+
+def resultkey(result):
+    return result['name'], result['rows'], result['partitions'], result['method']
+
+
+def compareresults(results, baseline, tolerance):
+    """
+    Matches @results against the @baseline records. A timing is a regression when it is more than
+    @tolerance slower than the baseline, a rate when it is more than @tolerance lower.
+    :return: list of (result, baseline value, ratio, regressed) for the records found in both
+    """
+    previous = {resultkey(result): result['value'] for result in baseline}
+    comparisons = []
+    for result in results:
+        before = previous.get(resultkey(result))
+        if not before or not result['value']:
+            continue
+        if result['unit'] == 's':
+            ratio = result['value'] / before
+        else:
+            ratio = before / result['value']
+        comparisons.append((result, before, ratio, ratio > 1 + tolerance))
+    return comparisons
+
+
+def serverversion(openconnection):
+    with openconnection.cursor() as cur:
+        cur.execute("SHOW server_version")
+        return cur.fetchone()[0]
+
+
+def main(argv=None):
+    global REPEAT
+    parser = argparse.ArgumentParser(description="Benchmark for the partitioning functions")
+    parser.add_argument('inputfile', nargs='?', default=INPUT_FILE_PATH, help="ratings file (without --rows)")
+    parser.add_argument('counts', nargs='*', type=int, metavar='partitions', help="numbers of partitions")
+    parser.add_argument('--partitions', nargs='+', type=int, help="numbers of partitions")
+    parser.add_argument('--rows', nargs='+', help="generate ratings of these sizes instead, e.g. 1M 10M 25M")
+    parser.add_argument('--methods', nargs='+', default=list(PARTITION_METHODS), choices=PARTITION_METHODS)
+    parser.add_argument('--user-skew', type=float, default=USER_SKEW, help="Zipf exponent of user activity")
+    parser.add_argument('--movie-skew', type=float, default=MOVIE_SKEW, help="Zipf exponent of movie popularity")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="runs per measurement (best kept)")
+    parser.add_argument('--data-dir', default=tempfile.gettempdir(), help="where generated ratings are kept")
+    parser.add_argument('--output', help="JSON file for the results")
+    parser.add_argument('--metrics', help="JSON file for the per-phase metrics collected during the run")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+    REPEAT = args.repeat
+    partitioncounts = args.partitions or args.counts or PARTITION_COUNTS
+    if args.metrics:
+        MyAssignment.METRICS.enable()
+
+    results = []
+    testHelper.createdb(DATABASE_NAME)
+    with testHelper.getopenconnection(dbname=DATABASE_NAME) as conn:
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        version = serverversion(conn)
+        if args.rows:
+            for rows in map(parsecount, args.rows):
+                path = datasetpath(args.data_dir, rows, args.user_skew, args.movie_skew, args.seed)
+                testHelper.deleteAllPublicTables(conn)
+                results.extend(runsuite(path, rows, partitioncounts, args.methods, conn))
+        elif args.output or args.baseline:
+            with open(args.inputfile, 'rb') as f:
+                rows = sum(1 for _ in f)
+            testHelper.deleteAllPublicTables(conn)
+            results.extend(runsuite(args.inputfile, rows, partitioncounts, args.methods, conn))
+        else:
+            testHelper.deleteAllPublicTables(conn)
+            report(args.inputfile, partitioncounts, conn)
+        testHelper.deleteAllPublicTables(conn)
+    conn.close()
+
+    for result in results:
+        print('{0:<24} rows={1:<10} n={2!s:<4} {3:<12} {4:14.4f} {5}'.format(
+            result['name'], result['rows'], result['partitions'], result['method'], result['value'], result['unit']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                            'cpus': os.cpu_count(), 'postgresql': version},
+                'settings': {'user_skew': args.user_skew, 'movie_skew': args.movie_skew, 'seed': args.seed,
+                             'repeat': args.repeat},
+                'results': results,
+            }, f, indent=2)
+    if args.metrics:
+        MyAssignment.METRICS.to_json(args.metrics)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = 0
+        for result, before, ratio, regressed in compareresults(results, baseline, args.tolerance):
+            regressions += regressed
+            print('{0:<24} rows={1:<10} n={2!s:<4} {3:<12} x{4:.2f} vs baseline {5:.4f}{6}'.format(
+                result['name'], result['rows'], result['partitions'], result['method'], ratio, before,
+                '  REGRESSION' if regressed else ''))
+        if regressions:
+            print('{0} measurement(s) regressed by more than {1:.0%}'.format(regressions, args.tolerance))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
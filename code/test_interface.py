@@ -0,0 +1,460 @@
+#
+# Unit tests of Interface.py. Run with: python -m pytest -q
+# The tests using the `pool` fixture need the local PostgreSQL server of Assignment1Tester and are skipped
+# without it; the others need no database.
+#
+
+import random
+import re
+import threading
+import time
+
+import psycopg2
+import pytest
+
+import Interface as MyAssignment
+import testHelper
+
+TEST_DATABASE = 'dds_assgn1_unittest'
+RATINGS_TABLE = 'ratings'
+INPUT_FILE_PATH = 'test_data.dat'
+ACTUAL_ROWS_IN_INPUT_FILE = 20
+
+
+def uniform_histogram(step=0.5, rows=10):
+    """
+    (rating, rows) histogram with @rows rows for every rating step..5.0.
+    """
+    return [(step * k, rows) for k in range(1, int(5.0 / step) + 1)]
+
+
+def random_histogram(seed):
+    generator = random.Random(seed)
+    ratings = sorted(generator.sample([k / 2 for k in range(11)], generator.randint(1, 11)))
+    return [(rating, generator.randint(1, 1000)) for rating in ratings]
+
+
+def interval_of(rating, bounds):
+    return MyAssignment.range_partition_index(rating, bounds)
+
+
+# Range repartitioning
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('oldcount,numberofpartitions', [(1, 4), (2, 5), (3, 8), (5, 6)])
+def test_split_range_bounds_only_adds_bounds(seed, oldcount, numberofpartitions):
+    histogram = random_histogram(seed)
+    bounds = MyAssignment.range_partition_bounds(oldcount)
+    newbounds = MyAssignment.split_range_bounds(bounds, histogram, numberofpartitions)
+    assert len(newbounds) == numberofpartitions - 1
+    assert newbounds == sorted(set(newbounds))
+    assert set(bounds) <= set(newbounds)
+    assert all(0 <= bound <= 5.0 for bound in newbounds)
+
+
+def test_split_range_bounds_splits_the_fullest_interval_at_its_median():
+    histogram = [(0.5, 1), (1.0, 1), (3.0, 10), (3.5, 10), (4.0, 10), (4.5, 10)]
+    assert MyAssignment.split_range_bounds([2.5], histogram, 3) == [2.5, 3.5]
+
+
+def test_split_range_bounds_halves_the_widest_interval_without_rows():
+    assert MyAssignment.split_range_bounds([], [], 2) == [2.5]
+    assert MyAssignment.split_range_bounds([2.5], [(1.0, 5), (4.0, 5)], 3) == [1.25, 2.5]
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('oldcount,numberofpartitions', [(4, 1), (5, 2), (8, 3), (6, 5)])
+def test_merge_range_bounds_only_removes_bounds(seed, oldcount, numberofpartitions):
+    histogram = random_histogram(seed)
+    bounds = MyAssignment.range_partition_bounds(oldcount)
+    newbounds = MyAssignment.merge_range_bounds(bounds, histogram, numberofpartitions)
+    assert len(newbounds) == numberofpartitions - 1
+    assert newbounds == sorted(newbounds)
+    assert set(newbounds) <= set(bounds)
+
+
+def test_merge_range_bounds_merges_the_emptiest_neighbours():
+    histogram = [(1.0, 50), (2.0, 1), (3.0, 1), (4.0, 50)]
+    assert MyAssignment.merge_range_bounds([1.25, 2.5, 3.75], histogram, 3) == [1.25, 3.75]
+
+
+def test_resize_range_bounds_keeps_bounds_of_the_same_count():
+    bounds = [1.0, 2.0, 4.0]
+    assert MyAssignment.resize_range_bounds(bounds, uniform_histogram(), 4) == bounds
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('oldcount,numberofpartitions',
+                         [(1, 3), (2, 5), (3, 3), (4, 7), (5, 2), (7, 4), (3, 1)])
+def test_range_regroup_plan_moves_every_rating_to_its_new_partition(seed, oldcount, numberofpartitions):
+    histogram = random_histogram(seed)
+    bounds = MyAssignment.range_partition_bounds(oldcount)
+    newbounds = MyAssignment.resize_range_bounds(bounds, histogram, numberofpartitions)
+    first, last, keeper = MyAssignment.range_regroup_plan(bounds, newbounds)
+
+    # Every new partition is either kept from an old one or created once, and every old table survives
+    # or is merged into a kept one
+    assert set(keeper.values()) <= set(range(oldcount))
+    assert all(first[i] in keeper for i in range(oldcount))
+    assert all(0 <= first[i] <= last[i] < numberofpartitions for i in range(oldcount))
+    if numberofpartitions >= oldcount:
+        covered = [j for i in range(oldcount) for j in range(first[i], last[i] + 1)]
+        assert covered == list(range(numberofpartitions))
+    else:
+        assert sorted(keeper) == list(range(numberofpartitions))
+
+    # Partition 0 keeps its table, so the ratings outside [0, 5] stay where rangeinsert expects them
+    assert keeper[0] == 0
+    ratings = [-1.0, 0.0, 5.0, 6.0] + sorted({b for b in bounds + newbounds} | {k / 4 for k in range(21)})
+    for rating in ratings:
+        old = interval_of(rating, bounds)
+        assert first[old] <= interval_of(rating, newbounds) <= last[old]
+
+
+def test_range_regroup_plan_split_and_merge():
+    assert MyAssignment.range_regroup_plan([2.5], [1.25, 2.5, 3.75]) == ([0, 2], [1, 3], {0: 0, 2: 1})
+    assert MyAssignment.range_regroup_plan([1.25, 2.5, 3.75], [2.5]) == ([0, 0, 1, 1], [0, 0, 1, 1],
+                                                                        {0: 0, 1: 2})
+
+
+# Ratings file parsing
+def parse_block(text):
+    numpy = pytest.importorskip('numpy')
+    return MyAssignment.parse_ratings_block(numpy.frombuffer(text.encode(), dtype=numpy.uint8))
+
+
+def assert_parsed_like_lines(text):
+    userid, movieid, rating = parse_block(text)
+    assert (userid.dtype.name, movieid.dtype.name, rating.dtype.name) == ('int32', 'int32', 'float64')
+    expected = list(MyAssignment.parse_ratings_lines(text.splitlines()))
+    assert list(zip(userid.tolist(), movieid.tolist(), rating.tolist())) == expected
+
+
+def test_parse_ratings_block_matches_the_line_parser_on_the_test_data():
+    with open('test_data.dat') as f:
+        assert_parsed_like_lines(f.read())
+
+
+@pytest.mark.parametrize('text', [
+    '1::122::5::838985046\n2::185::4.5::838983525\n',
+    '1::122::5::838985046\n2::185::4.5::838983525',  # no newline after the last line
+    '1::122::5\n2::185::0.5\n',  # no timestamp
+    '1::122::5\n2::185::3.5',
+    '1::122::5::838985046\n\n7::8\n2::185::4.5::838983525\n',  # blank and short lines are skipped
+    '12::345::2.25::1\r\n6::7::1::2\r\n',
+    '2147483647::1::0::0\n',
+    '',
+])
+def test_parse_ratings_block_matches_the_line_parser(text):
+    assert_parsed_like_lines(text)
+
+
+def test_parse_ratings_block_rejects_ids_outside_integer():
+    with pytest.raises(ValueError):
+        parse_block('2147483648::1::5::0\n')
+
+
+# Equi-depth range bounds and partition pruning
+def test_equi_depth_bounds_without_rows_falls_back_to_equal_widths():
+    assert MyAssignment.equi_depth_bounds([], 4) == MyAssignment.range_partition_bounds(4)
+
+
+def test_equi_depth_bounds_of_uniform_ratings_are_equal_widths():
+    assert MyAssignment.equi_depth_bounds(uniform_histogram(), 5) == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_equi_depth_bounds_follow_the_rows():
+    histogram = [(1.0, 10), (3.0, 10), (4.0, 40), (4.5, 30), (5.0, 10)]
+    assert MyAssignment.equi_depth_bounds(histogram, 3) == [3.0, 4.0]
+
+
+@pytest.mark.parametrize('seed', range(30))
+@pytest.mark.parametrize('numberofpartitions', [1, 2, 3, 5, 8, 12])
+def test_equi_depth_bounds_give_every_rating_value_a_partition(seed, numberofpartitions):
+    histogram = random_histogram(seed)
+    bounds = MyAssignment.equi_depth_bounds(histogram, numberofpartitions)
+    assert len(bounds) == numberofpartitions - 1
+    assert all(a < b for a, b in zip(bounds, bounds[1:]))
+    used = {interval_of(rating, bounds) for rating, _ in histogram}
+    assert len(used) == min(len(histogram), numberofpartitions)
+
+
+@pytest.mark.parametrize('bounds', [[], [2.5], [1.0, 2.0, 3.0, 4.0], [0.0, 3.5, 3.75]])
+@pytest.mark.parametrize('lo,hi', [(-1.0, -0.5), (-1.0, 0.0), (0.0, 5.0), (1.0, 1.0), (1.5, 3.5),
+                                   (2.0, 2.0), (3.6, 4.9), (4.5, 7.0), (5.5, 6.0), (-2.0, 8.0)])
+def test_range_query_partitions_cover_every_matching_rating(bounds, lo, hi):
+    partitions = MyAssignment.range_query_partitions(lo, hi, bounds)
+    assert partitions == sorted(set(partitions))
+    ratings = [lo, hi] + bounds + [k / 8 for k in range(-16, 65)]
+    needed = {interval_of(rating, bounds) for rating in ratings if lo <= rating <= hi}
+    assert needed <= set(partitions)
+
+
+def test_range_query_partitions_prune():
+    bounds = [1.0, 2.0, 3.0, 4.0]
+    assert MyAssignment.range_query_partitions(2.5, 3.5, bounds) == [2, 3]
+    assert MyAssignment.range_query_partitions(2.0, 2.0, bounds) == [1]
+    assert MyAssignment.range_query_partitions(4.5, 7.0, bounds) == [0, 4]
+    assert MyAssignment.range_query_partitions(5.5, 6.0, bounds) == [0]
+    assert MyAssignment.range_query_partitions(3.0, 2.0, bounds) == []
+
+
+# Routing and insert statements
+def routed_inserts(statement):
+    """
+    (target table, source, WHERE predicate) of every INSERT ... SELECT of a routing statement.
+    """
+    pattern = re.compile(r"INSERT INTO (\w+) \(userid, movieid, rating\) SELECT userid, movieid, rating "
+                         r"FROM (\w+)(?: WHERE (.*?))?(?=\), route\d+ AS \(|\) INSERT INTO |$)")
+    return pattern.findall(statement)
+
+
+def matches(predicate, **row):
+    """
+    Evaluates a routing @predicate on @row (the predicates only use NOT, AND, comparisons and %).
+    """
+    python = predicate.replace('NOT ', 'not ').replace(' AND ', ' and ').replace(' = ', ' == ')
+    return eval(python.replace('true', 'True'), {}, row)
+
+
+@pytest.mark.parametrize('bounds', [[], [2.5], [1.0, 3.0], [0.0, 1.5, 2.0, 4.75]])
+def test_range_routing_statement_routes_like_rangeinsert(bounds):
+    layout = MyAssignment.PartitionLayout('range', 'ratings', len(bounds) + 1, bounds)
+    inserts = routed_inserts(MyAssignment.routing_statement('range_part', layout))
+    assert [table for table, _, _ in inserts] == [f"range_part{i}" for i in range(len(bounds) + 1)]
+    assert all(source == 'new_rows' for _, source, _ in inserts)
+    for rating in [-1.0, 0.0, 0.5, 1.0, 1.25, 2.5, 3.0, 4.75, 4.9, 5.0, 5.5] + bounds:
+        routed = [table for table, _, predicate in inserts if matches(predicate, rating=rating)]
+        assert routed == [f"range_part{MyAssignment.range_partition_index(rating, bounds)}"]
+
+
+@pytest.mark.parametrize('key', ['userid', 'movieid'])
+@pytest.mark.parametrize('numberofpartitions', [1, 2, 5])
+def test_hash_routing_statement_routes_like_hashinsert(key, numberofpartitions):
+    layout = MyAssignment.PartitionLayout('hash', 'ratings', numberofpartitions, None, 'tables', key)
+    inserts = routed_inserts(MyAssignment.routing_statement('hash_part', layout))
+    assert len(inserts) == numberofpartitions
+    for value in range(-7, 20):
+        routed = [table for table, _, predicate in inserts if matches(predicate, **{key: value})]
+        assert routed == [f"hash_part{MyAssignment.hash_partition_index(value, numberofpartitions)}"]
+
+
+def test_roundrobin_routing_statement_numbers_each_row_once():
+    layout = MyAssignment.PartitionLayout('roundrobin', 'ratings', 3, None)
+    statement = MyAssignment.routing_statement('rrobin_part', layout)
+    assert statement.count('nextval') == 1
+    assert ("numbered AS MATERIALIZED (SELECT userid, movieid, rating, "
+            f"nextval('{MyAssignment.RROBIN_INDEX_SEQUENCE}') % 3 AS slot FROM new_rows)") in statement
+    inserts = routed_inserts(statement)
+    assert all(source == 'numbered' for _, source, _ in inserts)
+    for slot in range(3):
+        assert [table for table, _, predicate in inserts if matches(predicate, slot=slot)] == [f"rrobin_part{slot}"]
+
+
+def test_declarative_routing_statement_inserts_into_the_parent():
+    layout = MyAssignment.PartitionLayout('range', 'ratings', 3, [1.0, 3.0], 'declarative')
+    assert MyAssignment.routing_statement('range_part', layout) == (
+        "INSERT INTO ratings_range_parts (userid, movieid, rating) SELECT userid, movieid, rating FROM new_rows")
+
+
+MAIN_INSERT = "INSERT INTO ratings (userid, movieid, rating) VALUES ($1, $2, $3)"
+
+
+@pytest.mark.parametrize('scheme,prefix', [('range', 'range_part'), ('hash', 'hash_part')])
+def test_insert_statement_writes_the_row_and_its_partition_in_one_statement(scheme, prefix):
+    layout = MyAssignment.PartitionLayout(scheme, 'ratings', 4, [1.0, 2.0, 3.0], 'tables', 'userid')
+    assert MyAssignment.insert_statement('ratings', prefix, layout, 2) == (
+        f"WITH main AS ({MAIN_INSERT}) INSERT INTO {prefix}2 (userid, movieid, rating) VALUES ($1, $2, $3)")
+
+
+def test_insert_statement_declarative_inserts_into_the_parent():
+    layout = MyAssignment.PartitionLayout('range', 'ratings', 4, [1.0, 2.0, 3.0], 'declarative')
+    assert MyAssignment.insert_statement('ratings', 'range_part', layout, 2) == (
+        f"WITH main AS ({MAIN_INSERT}) INSERT INTO ratings_range_parts (userid, movieid, rating) "
+        "VALUES ($1, $2, $3)")
+
+
+def test_insert_statement_with_trigger_routing_only_writes_the_main_table():
+    layout = MyAssignment.PartitionLayout('roundrobin', 'ratings', 3, None, 'tables', None, 'trigger')
+    assert MyAssignment.insert_statement('ratings', 'rrobin_part', layout) == MAIN_INSERT
+
+
+def test_roundrobin_insert_statement_routes_the_returned_row():
+    layout = MyAssignment.PartitionLayout('roundrobin', 'ratings', 3, None)
+    statement = MyAssignment.insert_statement('ratings', 'rrobin_part', layout)
+    assert statement.startswith(f"WITH new_rows AS ({MAIN_INSERT} RETURNING userid, movieid, rating), numbered AS ")
+    assert statement.count('INSERT INTO ratings ') == 1
+    assert statement.count('nextval') == 1
+    assert [table for table, _, _ in routed_inserts(statement)] == ['rrobin_part0', 'rrobin_part1', 'rrobin_part2']
+    # PREPARE declares exactly three parameters
+    assert set(re.findall(r"\$\d+", statement)) == {'$1', '$2', '$3'}
+
+
+# Connection pools
+@pytest.fixture
+def pool():
+    try:
+        testHelper.createdb(TEST_DATABASE)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"PostgreSQL is not available: {e}")
+    pool = MyAssignment.get_pool(user='postgres', password='1234', dbname=TEST_DATABASE)
+    with pool.connection() as conn:
+        conn.autocommit = True
+        testHelper.deleteAllPublicTables(conn)
+    yield pool
+    pool.closeall()
+
+
+def run_with_timeout(function, timeout=60):
+    """
+    Runs @function in a daemon thread so that a deadlock fails the test instead of hanging the suite.
+    """
+    errors = []
+
+    def run():
+        try:
+            function()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "deadlocked"
+    if errors:
+        raise errors[0]
+
+
+def count_rows(pool, prefix, numberofpartitions):
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(" UNION ALL ".join(f"SELECT COUNT(*) FROM {prefix}{i}" for i in range(numberofpartitions)))
+        return sum(count for count, in cur.fetchall())
+
+
+@pytest.mark.parametrize('workers', [MyAssignment.POOL_SIZE, MyAssignment.POOL_SIZE + 3])
+def test_parallel_builds_through_a_pool_do_not_deadlock(pool, workers):
+    # The caller's connection comes from the same pool the workers use
+    MyAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH, pool)
+    run_with_timeout(lambda: MyAssignment.rangepartition(RATINGS_TABLE, workers, pool, method='parallel',
+                                                         workers=workers))
+    run_with_timeout(lambda: MyAssignment.roundrobinpartition(RATINGS_TABLE, workers, pool, method='parallel',
+                                                              workers=workers))
+    assert count_rows(pool, 'range_part', workers) == ACTUAL_ROWS_IN_INPUT_FILE
+    assert count_rows(pool, 'rrobin_part', workers) == ACTUAL_ROWS_IN_INPUT_FILE
+    assert pool.in_use == 0
+
+
+def test_pool_reserve_counts_the_connections_in_use(pool):
+    small = MyAssignment.ConnectionPool(2, **pool.params)
+    with small.connection(), small.connection():
+        small.reserve(3)
+        connections = [small.acquire(timeout=10) for _ in range(3)]
+        assert small.in_use == 5
+        for conn in connections:
+            small.release(conn)
+    small.closeall()
+
+
+# BufferedWriter
+def test_buffered_writer_gives_the_connection_back_when_construction_fails(pool, monkeypatch):
+    with pytest.raises(ValueError):
+        MyAssignment.BufferedWriter(RATINGS_TABLE, pool, scheme='hash')
+    assert pool.in_use == 0
+
+    def broken_catalog(prefix, openconnection):
+        raise psycopg2.OperationalError("catalog unavailable")
+    monkeypatch.setattr(MyAssignment, 'partition_layout', broken_catalog)
+    with pytest.raises(psycopg2.OperationalError):
+        MyAssignment.BufferedWriter(RATINGS_TABLE, pool, scheme='range')
+    assert pool.in_use == 0
+
+
+def test_buffered_writer_keeps_the_row_that_reports_a_background_flush_error(pool):
+    MyAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH, pool)
+    MyAssignment.rangepartition(RATINGS_TABLE, 3, pool)
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(f"ALTER TABLE {RATINGS_TABLE} RENAME TO {RATINGS_TABLE}_away")
+        conn.commit()
+
+    writer = MyAssignment.BufferedWriter(RATINGS_TABLE, pool, scheme='range', max_delay=0.05)
+    for userid in range(3):
+        writer.insert(userid, 1, 2.5)
+    for _ in range(200):
+        if writer.error is not None:
+            break
+        time.sleep(0.05)
+    assert isinstance(writer.error, psycopg2.Error)
+
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(f"ALTER TABLE {RATINGS_TABLE}_away RENAME TO {RATINGS_TABLE}")
+        conn.commit()
+    with pytest.raises(psycopg2.Error):
+        writer.insert(3, 1, 2.5)
+    writer.close()
+    assert count_rows(pool, 'range_part', 3) == ACTUAL_ROWS_IN_INPUT_FILE + 4
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM {RATINGS_TABLE} WHERE movieid = 1 AND rating = 2.5")
+        assert cur.fetchone()[0] == 4
+
+
+# Declarative range partitions
+def range_contents(pool, numberofpartitions):
+    with pool.connection() as conn, conn.cursor() as cur:
+        contents = []
+        for i in range(numberofpartitions):
+            cur.execute(f"SELECT userid, movieid, rating FROM range_part{i} ORDER BY 1, 2, 3")
+            contents.append(cur.fetchall())
+        return contents
+
+
+@pytest.mark.parametrize('boundaries', ['equal_width', [0.0, 5.0, 5.000000000000001]])
+def test_declarative_range_partitions_hold_the_same_rows_as_tables(pool, boundaries):
+    contents = {}
+    for backend in MyAssignment.PARTITION_BACKENDS:
+        MyAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH, pool)
+        MyAssignment.rangepartition(RATINGS_TABLE, 4, pool, backend=backend, boundaries=boundaries)
+        for userid, rating in [(900, -1.0), (901, 0.0), (902, 2.5), (903, 5.0), (904, 6.0)]:
+            MyAssignment.rangeinsert(RATINGS_TABLE, userid, 1, rating, pool)
+        MyAssignment.rangeinsert_many(RATINGS_TABLE, [(905, 1, 7.5), (906, 1, -0.5)], pool)
+        contents[backend] = range_contents(pool, 4)
+        with pool.connection() as conn:
+            assert [row for row in MyAssignment.rangequery(5.5, 8.0, conn)] == [(904, 1, 6.0), (905, 1, 7.5)]
+        MyAssignment.repartition('range', 6, pool)
+        contents[backend, 'repartitioned'] = range_contents(pool, 6)
+    assert contents['declarative'] == contents['tables']
+    assert contents['declarative', 'repartitioned'] == contents['tables', 'repartitioned']
+    assert {(900, 1, -1.0), (904, 1, 6.0)} <= set(contents['tables'][0])
+
+
+# Range queries
+def test_range_queries_stream_inside_a_with_block_on_an_autocommit_connection(pool):
+    MyAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH, pool)
+    MyAssignment.rangepartition(RATINGS_TABLE, 3, pool)
+    with pool.connection() as conn:
+        expected = sorted(MyAssignment.rangequery(1.5, 3.5, conn))
+    conn = testHelper.getopenconnection(dbname=TEST_DATABASE)
+    try:
+        conn.autocommit = True
+        # psycopg2 >= 2.9 opens a transaction for the with block although autocommit is on
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT COUNT(*) FROM {RATINGS_TABLE}")
+            assert sorted(MyAssignment.rangequery(1.5, 3.5, conn)) == expected
+            assert sorted(MyAssignment.rangequery(1.5, 3.5, conn)) == expected
+    finally:
+        conn.close()
+    assert expected
+
+
+# Parallel file loading
+def test_read_chunk_lines_splits_on_line_boundaries(tmp_path):
+    path = tmp_path / 'ratings.dat'
+    path.write_bytes(b'1::2::3.5::0\n10::20::4::0\n100::200::5::0\n')
+    lines = list(MyAssignment.read_chunk_lines(str(path), 0, path.stat().st_size, block_size=5))
+    assert lines == ['1::2::3.5::0', '10::20::4::0', '100::200::5::0']
+
+
+def test_read_chunk_lines_fails_when_the_file_shrank(tmp_path):
+    path = tmp_path / 'ratings.dat'
+    path.write_bytes(b'1::2::3.5::0\n10::20::4::0\n')
+    with pytest.raises(ValueError):
+        run_with_timeout(lambda: list(MyAssignment.read_chunk_lines(str(path), 0, 1000, block_size=8)), timeout=10)